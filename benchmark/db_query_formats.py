@@ -0,0 +1,62 @@
+"""Compares the time and peak memory of DBQueryHandler.get result formats on a SQLite table.
+
+Run from the repository root: ``python benchmark/db_query_formats.py [rows]``
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from pyboot.common.database import DBQueryHandler, FORMAT_DICT, FORMAT_TUPLE, FORMAT_NAMED, FORMAT_COLUMNAR
+
+QUERY = "select id, customer_id, amount, status from benchmark_orders"
+
+
+def make_db(rows):
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(text("create table benchmark_orders "
+                                "(id integer primary key, customer_id integer, amount float, status varchar(16))"))
+        connection.execute(text("insert into benchmark_orders values (:id, :customer_id, :amount, :status)"),
+                           [{"id": i, "customer_id": i % 97, "amount": i * 0.25, "status": "open"}
+                            for i in range(rows)])
+    return sessionmaker(bind=engine)()
+
+
+def total_amount(result, format):
+    if format == FORMAT_DICT: return sum(row["amount"] for row in result)
+    if format == FORMAT_TUPLE: return sum(row[2] for row in result)
+    if format == FORMAT_NAMED: return sum(row.amount for row in result)
+    return sum(result["amount"])
+
+
+def run(db, format):
+    start = time.perf_counter()
+    result = DBQueryHandler.get(db, QUERY, format=format)
+    fetched = time.perf_counter()
+    total = total_amount(result, format)
+    done = time.perf_counter()
+    del result
+
+    # Memory is measured on a separate run, tracemalloc slows allocation down considerably
+    tracemalloc.start()
+    result = DBQueryHandler.get(db, QUERY, format=format)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    print("%-10s fetch %7.1f ms  sum %6.1f ms  retained %6.1f MiB  peak %6.1f MiB  (total %s)" % (
+        format, (fetched - start) * 1000, (done - fetched) * 1000, retained / 1024 / 1024, peak / 1024 / 1024,
+        total))
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    db = make_db(rows)
+    print("%s rows" % rows)
+    for format in (FORMAT_DICT, FORMAT_TUPLE, FORMAT_NAMED, FORMAT_COLUMNAR):
+        run(db, format)
@@ -0,0 +1,77 @@
+"""Compares the compiled per-class serializer and the batch ``to_json_dicts`` path with the old per-field
+``_to_dict_field`` path.
+
+Run from the repository root: ``python benchmark/model_serialization.py``
+"""
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import Boolean, Column, Date, DateTime, Float, Integer, String
+
+from pyboot.model import DatabaseModelBase
+
+ROWS = 500
+REPEAT = 5
+
+
+class Order(DatabaseModelBase):
+    __tablename__ = "benchmark_orders"
+
+    reference = Column(String)
+    customer_id = Column(Integer)
+    item_count = Column(Integer)
+    amount = Column(Float)
+    discount = Column(Float)
+    paid = Column(Boolean)
+    shipped = Column(Boolean)
+    status = Column(String)
+    order_date = Column(Date)
+    created_on = Column(DateTime)
+    updated_on = Column(DateTime)
+
+
+def legacy_to_dict(model):
+    obj_dict = {}
+    if model.id: obj_dict["id"] = model.id
+    fields = model.__class__._get_fields()
+    for field_name in fields.keys():
+        model._to_dict_field(obj_dict, field_name, fields[field_name])
+    return obj_dict
+
+
+def legacy_to_json_dict(model):
+    json_dict = legacy_to_dict(model)
+    fields = model.__class__._get_fields()
+    for field_name in fields.keys():
+        if fields[field_name] == "obj":
+            model._include_obj(json_dict, None, field_name)
+    return json_dict
+
+
+def make_rows():
+    now = datetime.datetime(2016, 8, 17, 9, 54, 53)
+    return [Order(id=i + 1, reference="ORD-%s" % i, customer_id=i % 37, item_count=i % 5, amount=i * 1.5,
+                  discount=0.0, paid=i % 2 == 0, shipped=i % 3 == 0, status="open", order_date=now.date(),
+                  created_on=now, updated_on=now) for i in range(ROWS)]
+
+
+def run(name, fn, rows, batch=False):
+    stmt = (lambda: fn(rows)) if batch else (lambda: [fn(row) for row in rows])
+    best = min(timeit.repeat(stmt, number=20, repeat=REPEAT)) / 20
+    print("%-28s %8.3f ms per %s rows" % (name, best * 1000, len(rows)))
+    return best
+
+
+if __name__ == "__main__":
+    rows = make_rows()
+    assert [row.to_json_dict() for row in rows] == [legacy_to_json_dict(row) for row in rows]
+    assert Order.to_json_dicts(rows) == [legacy_to_json_dict(row) for row in rows]
+
+    legacy = run("legacy to_json_dict", legacy_to_json_dict, rows)
+    compiled = run("compiled to_json_dict", lambda row: row.to_json_dict(), rows)
+    batch = run("batch to_json_dicts", Order.to_json_dicts, rows, batch=True)
+    print("speedup: %.2fx compiled, %.2fx batch" % (legacy / compiled, legacy / batch))
@@ -1,4 +1,6 @@
+import gc
 import logging
+import os
 from logging import config
 
 import yaml
@@ -10,6 +12,7 @@ API_MAX_RECORDS = 25
 # TODO: Need to make it non-sigleton and make it generic
 class Conf(object):
     __instance = None
+    __fork_hooks = False
 
     def __init__(self):
         self.app_conf = None
@@ -29,8 +32,18 @@ class Conf(object):
         stream = open(app_conf_path, "r")
         self.app_conf = yaml.load(stream)
         stream.close()
+        if self.get_value("gc_freeze_on_fork", False): Conf.__freeze_on_fork()
         logging.debug("Config initialized")
 
+    @staticmethod
+    def __freeze_on_fork():
+        # Moves everything loaded before a fork (conf, models, engines) to the GC's permanent generation, so
+        # collections in forked workers don't write to those objects and copy the pages they share. The parent
+        # unfreezes right after, so it keeps collecting what it allocates between forks.
+        if Conf.__fork_hooks or not hasattr(os, "register_at_fork"): return
+        os.register_at_fork(before=gc.freeze, after_in_parent=gc.unfreeze)
+        Conf.__fork_hooks = True
+
     def get_value(self, key, default=None):
         if key not in self.app_conf: return default
         return self.app_conf[key]
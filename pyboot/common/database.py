@@ -1,19 +1,394 @@
+import array
+import heapq
+import itertools
 import logging
-from contextlib import contextmanager
+import os
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
 
-import datetime
+from flask import current_app, g, has_app_context
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import QueuePool
 
 from pyboot.common.conf import Conf
-from pyboot.util.common import DatetimeUtil
+from pyboot.common.exception import InvalidValueException, InvalidStateException, QueryBudgetExceededException
+from pyboot.util.metrics import Histogram, prometheus_lines
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+PRIMARY = "primary"
+
+ROUND_ROBIN = "round_robin"
+LEAST_OUTSTANDING = "least_outstanding"
+
+
+def mysql_replica_lag(engine):
+    """Returns the replica's ``Seconds_Behind_Source`` (``Seconds_Behind_Master`` before MySQL 8.0.22 and on
+    MariaDB), ``None`` when it is not replicating."""
+    try:
+        status = _replica_status(engine, "SHOW REPLICA STATUS")
+    except DBAPIError:
+        # Before MySQL 8.0.22 and MariaDB 10.5.1; MySQL 8.4 only knows the new statement
+        status = _replica_status(engine, "SHOW SLAVE STATUS")
+    if status is None: return None
+    return status["Seconds_Behind_Source"] if "Seconds_Behind_Source" in status else status.get("Seconds_Behind_Master")
+
+
+def _replica_status(engine, statement: str):
+    with engine.connect() as connection:
+        result = connection.execute(text(statement))
+        keys = list(result.keys())
+        row = result.first()
+    return dict(zip(keys, row)) if row is not None else None
+
+
+class ReplicaRouter(object):
+    """Picks the replica for read-only sessions.
+
+    ``ROUND_ROBIN`` rotates over the replicas, ``LEAST_OUTSTANDING`` takes the one with the fewest checked
+    out connections. With ``max_lag`` set, replicas whose ``lag_check(engine)`` is unknown or above it are
+    skipped; each replica is checked at most once per ``lag_check_interval`` seconds.
+    """
+
+    def __init__(self, engines: dict, policy: str = ROUND_ROBIN, max_lag: float = None,
+                 lag_check_interval: float = 5, lag_check=mysql_replica_lag):
+        if policy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise InvalidValueException("Invalid replica policy '%s'" % policy)
+        self.engines = engines
+        self.names = list(engines)
+        self.policy = policy
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.lag_check = lag_check
+        self.__counter = itertools.count()
+        self.__health = {}
+
+    def choose(self):
+        if not self.names: return None
+        if self.policy == LEAST_OUTSTANDING:
+            candidates = sorted(self.names, key=lambda name: self.__checked_out(self.engines[name]))
+        else:
+            start = next(self.__counter) % len(self.names)
+            candidates = self.names[start:] + self.names[:start]
+
+        for name in candidates:
+            if self.is_healthy(name): return name
+        return None
+
+    def reset(self):
+        self.__health = {}
+
+    def is_healthy(self, name: str) -> bool:
+        if self.max_lag is None: return True
+        now = time.monotonic()
+        health = self.__health.get(name)
+        if health is not None and now - health[0] < self.lag_check_interval: return health[1]
+
+        try:
+            lag = self.lag_check(self.engines[name])
+            healthy = lag is not None and lag <= self.max_lag
+            if not healthy: logging.warning("Replica %s is lagging: %s seconds" % (name, lag))
+        except Exception as e:
+            logging.warning("Replica %s lag check failed: %s" % (name, e))
+            healthy = False
+        self.__health[name] = (now, healthy)
+        return healthy
+
+    @staticmethod
+    def __checked_out(engine) -> int:
+        checkedout = getattr(engine.pool, "checkedout", None)
+        return checkedout() if checkedout else 0
+
+
+STATEMENT_TYPES = frozenset(("select", "insert", "update", "delete", "with", "show"))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """``QueuePool`` that reports how long each checkout waited to its ``metrics``."""
+    metrics = None
+
+    def _do_get(self):
+        if self.metrics is None: return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.checkout_wait.observe(time.perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class PoolMetrics(object):
+    """Pool and statement metrics of one engine, collected from SQLAlchemy events."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.reset()
+
+        if isinstance(engine.pool, InstrumentedQueuePool): engine.pool.metrics = self
+        event.listen(engine, "connect", self.__on_connect)
+        event.listen(engine, "checkout", self.__on_checkout)
+        event.listen(engine, "before_cursor_execute", self.__before_execute)
+        event.listen(engine, "after_cursor_execute", self.__after_execute)
+
+    def reset(self):
+        self.checkout_wait = Histogram()
+        self.statements = {}
+        self.connections_created = 0
+        self.connections_recycled = 0
+        self.checkouts = 0
+        self.__records = weakref.WeakSet()
+
+    def __on_connect(self, dbapi_connection, connection_record):
+        if connection_record in self.__records:
+            self.connections_recycled += 1
+        else:
+            self.__records.add(connection_record)
+        self.connections_created += 1
+
+    def __on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+
+    @staticmethod
+    def __before_execute(conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context, which is dropped with the statement even when it fails
+        if context is not None: context._pyboot_metrics_start = time.perf_counter()
+
+    def __after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_pyboot_metrics_start", None)
+        if start is None: return
+        elapsed = time.perf_counter() - start
+        words = statement.split(None, 1)
+        statement_type = words[0].lower() if words else ""
+        if statement_type not in STATEMENT_TYPES: statement_type = "other"
+        histogram = self.statements.get(statement_type)
+        if histogram is None: histogram = self.statements.setdefault(statement_type, Histogram())
+        histogram.observe(elapsed)
+
+    def stats(self) -> dict:
+        pool = self.engine.pool
+        gauge = lambda name: getattr(pool, name)() if hasattr(pool, name) else None
+        return {"pool_size": gauge("size"), "checked_out": gauge("checkedout"), "checked_in": gauge("checkedin"),
+                "overflow": gauge("overflow"), "checkouts": self.checkouts,
+                "connections_created": self.connections_created, "connections_recycled": self.connections_recycled,
+                "checkout_wait": self.checkout_wait.snapshot(),
+                "statements": dict((statement_type, histogram.snapshot())
+                                   for statement_type, histogram in list(self.statements.items()))}
+
+
+class QueryTracer(object):
+    """Counts the statements, DB time and rows of one request.
+
+    ``Controller.api_controller`` starts a tracer per request when ``database.query_trace`` is on (the default),
+    and every engine created by ``Db`` reports to the tracer of the current app context. When the request
+    spends more than ``slow_request_ms`` in the DB or runs more than ``query_budget`` statements it is logged
+    with its slowest statements; with ``query_budget_strict`` the statement over budget raises
+    ``QueryBudgetExceededException`` instead. Rows are the driver's ``rowcount``, which MySQL reports for
+    selects too.
+    """
+
+    def __init__(self, name: str = None, slow_request_ms: float = None, query_budget: int = None,
+                 strict: bool = False, slowest: int = 5):
+        self.name = name
+        self.slow_request_ms = slow_request_ms
+        self.query_budget = query_budget
+        self.strict = strict
+        self.statements = 0
+        self.rows = 0
+        self.time = 0.0
+        self.__keep = slowest
+        self.__slowest = []
+
+    @staticmethod
+    def current():
+        return g.get("pyboot_query_tracer") if has_app_context() else None
+
+    @staticmethod
+    def start(name: str = None):
+        """Starts tracing the current app context as configured in ``Conf``; returns ``None`` when disabled."""
+        db_conf = Conf.get("database") if Conf.get_instance().app_conf else None
+        if not db_conf or not db_conf.get("query_trace", True): return None
+        tracer = QueryTracer(name, slow_request_ms=db_conf.get("slow_request_ms"),
+                             query_budget=db_conf.get("query_budget"),
+                             strict=db_conf.get("query_budget_strict", False))
+        g.pyboot_query_tracer = tracer
+        return tracer
+
+    @staticmethod
+    def instrument(engine):
+        event.listen(engine, "before_cursor_execute", QueryTracer.__before_execute)
+        event.listen(engine, "after_cursor_execute", QueryTracer.__after_execute)
+
+    @staticmethod
+    def __before_execute(conn, cursor, statement, parameters, context, executemany):
+        tracer = QueryTracer.current()
+        if tracer is None: return
+        if tracer.strict and tracer.query_budget is not None and tracer.statements >= tracer.query_budget:
+            raise QueryBudgetExceededException("%s exceeded its budget of %s queries" % (
+                tracer.name or "Request", tracer.query_budget))
+        if context is not None: context._pyboot_trace_start = time.perf_counter()
+
+    @staticmethod
+    def __after_execute(conn, cursor, statement, parameters, context, executemany):
+        tracer = QueryTracer.current()
+        start = getattr(context, "_pyboot_trace_start", None)
+        if tracer is None or start is None: return
+        tracer.record(statement, time.perf_counter() - start, cursor.rowcount)
+
+    def record(self, statement: str, elapsed: float, rows: int = 0):
+        self.statements += 1
+        self.time += elapsed
+        if rows and rows > 0: self.rows += rows
+        if len(self.__slowest) < self.__keep:
+            heapq.heappush(self.__slowest, (elapsed, self.statements, statement))
+        elif elapsed > self.__slowest[0][0]:
+            heapq.heapreplace(self.__slowest, (elapsed, self.statements, statement))
+
+    def slowest(self) -> list:
+        """``(milliseconds, statement)`` of the slowest statements, slowest first."""
+        return [(elapsed * 1000, statement) for elapsed, _, statement in sorted(self.__slowest, reverse=True)]
+
+    def is_slow(self) -> bool:
+        return (self.slow_request_ms is not None and self.time * 1000 > self.slow_request_ms) or \
+               (self.query_budget is not None and self.statements > self.query_budget)
+
+    def server_timing(self) -> str:
+        return 'db;dur=%.2f;desc="%s queries, %s rows"' % (self.time * 1000, self.statements, self.rows)
+
+    def finish(self, response=None):
+        """Ends the trace, logs it when slow and adds the ``Server-Timing`` header to ``response``.
+
+        A streamed response keeps tracing the statements run while its body is sent, and is logged once
+        it is closed; its ``Server-Timing`` only covers the view.
+        """
+        if response is not None:
+            timing = response.headers.get("Server-Timing")
+            response.headers["Server-Timing"] = "%s, %s" % (timing, self.server_timing()) if timing \
+                else self.server_timing()
+            if response.is_streamed:
+                response.call_on_close(self.__log_if_slow)
+                return response
+        if has_app_context() and g.get("pyboot_query_tracer") is self: g.pop("pyboot_query_tracer")
+        self.__log_if_slow()
+        return response
+
+    def __log_if_slow(self):
+        if not self.is_slow(): return
+        logging.warning("Slow request [%s]: %s queries, %s rows, %.2f ms in DB; slowest: %s" % (
+            self.name, self.statements, self.rows, self.time * 1000,
+            "; ".join("%.2f ms %s" % (elapsed, " ".join(statement.split())) for elapsed, statement in self.slowest())))
+
+
+SHARD_MODULO = "modulo"
+SHARD_RANGE = "range"
+SHARD_LOOKUP = "lookup"
+
+
+class ShardRouter(object):
+    """Maps shard keys (tenant ids) to shard names.
+
+    ``SHARD_MODULO`` takes the key (the CRC32 of strings) modulo the shard count, ``SHARD_RANGE`` picks the
+    shard whose ``[low, high)`` range holds the key (``None`` bounds are open) and ``SHARD_LOOKUP`` reads the
+    ``lookup`` table, then ``default``. ``function`` may also be any ``function(key) -> shard name``.
+    """
+
+    def __init__(self, names: list, function=SHARD_MODULO, ranges: dict = None, lookup: dict = None,
+                 default: str = None):
+        self.names = list(names)
+        self.ranges = ranges or {}
+        self.lookup = lookup or {}
+        self.default = default
+        if callable(function):
+            self.function = function
+        elif function == SHARD_MODULO:
+            self.function = self.__modulo
+        elif function == SHARD_RANGE:
+            self.function = self.__range
+        elif function == SHARD_LOOKUP:
+            self.function = self.__lookup
+        else:
+            raise InvalidValueException("Invalid shard function '%s'" % function)
+
+    def shard_for(self, key) -> str:
+        name = self.function(key)
+        if name not in self.names: raise InvalidValueException("No shard for key '%s'" % key)
+        return name
+
+    def __modulo(self, key):
+        if isinstance(key, str): key = zlib.crc32(key.encode("utf-8"))
+        return self.names[int(key) % len(self.names)]
+
+    def __range(self, key):
+        for name, (low, high) in self.ranges.items():
+            if (low is None or low <= key) and (high is None or key < high): return name
+        return self.default
+
+    def __lookup(self, key):
+        name = self.lookup.get(key)
+        if name is None: name = self.lookup.get(str(key), self.default)
+        return name
 
 
 # TODO: Need to make it non-sigleton and make it generic
 class Db(object):
+    """Session factory for the ``database`` block of ``Conf``.
+
+    Read replicas are listed under ``database.replicas``; each entry overrides the primary's settings
+    (``host``, ``url``, pool sizes...) and may have a ``name``. ``Db.get(readonly=True)`` routes to a replica
+    chosen by ``replica_policy``, falling back to the primary when none is healthy. After a commit on the
+    primary, read-only sessions stay on the primary for the rest of the request (or for
+    ``replica_sticky_seconds`` outside of a request) so callers read their own writes.
+
+    Every engine is instrumented with ``PoolMetrics`` unless ``metrics`` is false; see ``Db.stats()`` and
+    ``prometheus_metrics()``.
+
+    After ``Db.init_app(app)``, sessions are scoped to the Flask app context: every ``Db.get()`` of a request
+    shares one session (and connection) per engine, errors still roll it back, and it is committed (or rolled
+    back when the request failed) and removed once at teardown. Outside an app context ``Db.get()`` keeps
+    opening and closing a session per call.
+
+    Engines hold no connection until first used and forked children drop the pools they inherit (without
+    closing the parent's connections), so ``Db.init()`` can run in a pre-fork master. Workers that should open
+    ``init_pool_size`` connections up front call ``Db.get_instance().warmup()`` from the server's post-fork
+    hook, so other forked processes stay without connections; ``pool_pre_ping`` pings them on checkout.
+
+    Sharded tables live on the ``database.shards`` engines, configured like replicas plus a ``key_range`` for
+    the ``range`` ``shard_function`` (``shard_lookup``/``shard_default`` for ``lookup``, ``modulo`` by
+    default). ``Db.get(shard_key=...)`` opens a session on the key's shard; ``Db.shard_sessions()`` and
+    ``Db.executor()`` feed ``DatabaseModel.get_all_sharded``.
+    """
     __Session = None
     __instance = None
+    __engines = {}
+    __metrics = {}
+    __sessions = {}
+    __router = None
+    __sticky_seconds = 5
+    __local = threading.local()
+    __scoped = None
+    __apps = weakref.WeakSet()
+    __fork_hooks = False
+    __shards = None
+    __executor = None
 
     @staticmethod
     def get_instance():
@@ -22,66 +397,485 @@ class Db(object):
         return Db.__instance
 
     def init(self):
-        Db.__Session = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=self.get_engine())
+        db_conf = Conf.get("database")
+        engines = OrderedDict([(PRIMARY, self.get_engine(db_conf))])
+        replicas = []
+        for index, replica_conf in enumerate(db_conf.get("replicas") or []):
+            name = replica_conf.get("name") or "replica%s" % (index + 1)
+            engines[name] = self.get_engine(Db.__merged_conf(db_conf, replica_conf))
+            replicas.append(name)
+        shard_ranges = OrderedDict()
+        for index, shard_conf in enumerate(db_conf.get("shards") or []):
+            name = shard_conf.get("name") or "shard%s" % (index + 1)
+            engines[name] = self.get_engine(Db.__merged_conf(db_conf, shard_conf))
+            shard_ranges[name] = shard_conf.get("key_range") or (None, None)
+
+        Db.__engines = engines
+        Db.__metrics = OrderedDict((name, PoolMetrics(engine)) for name, engine in engines.items()) \
+            if db_conf.get("metrics", True) else {}
+        if db_conf.get("query_trace", True):
+            for engine in engines.values():
+                QueryTracer.instrument(engine)
+        Db.__sessions = OrderedDict((name, self.__sessionmaker(name, engine, name in replicas, name in shard_ranges))
+                                    for name, engine in engines.items())
+        Db.__Session = Db.__sessions[PRIMARY]
+        Db.__router = ReplicaRouter(OrderedDict((name, engines[name]) for name in replicas),
+                                    policy=db_conf.get("replica_policy", ROUND_ROBIN),
+                                    max_lag=db_conf.get("max_replica_lag"),
+                                    lag_check_interval=db_conf.get("replica_lag_check_interval", 5))
+        Db.__sticky_seconds = db_conf.get("replica_sticky_seconds", 5)
+        Db.__shards = ShardRouter(shard_ranges, function=db_conf.get("shard_function", SHARD_MODULO),
+                                  ranges=shard_ranges, lookup=db_conf.get("shard_lookup"),
+                                  default=db_conf.get("shard_default")) if shard_ranges else None
+        if Db.__executor is not None: Db.__executor.shutdown(wait=False)
+        Db.__executor = None
+        if Db.__scoped is not None: Db.__scoped = Db.__scoped_sessions()
+        if not Db.__fork_hooks and hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=Db.__after_fork)
+            Db.__fork_hooks = True
         logging.debug("DbConfig initialized")
 
-    def get_engine(self):
-        db_conf = Conf.get("database")
-        db_baseurl = "mysql://%s/%s?charset=%s&user=%s&passwd=%s" % (
-            db_conf["host"], db_conf["name"], db_conf["charset"], db_conf["user"], db_conf["password"])
+    @staticmethod
+    def __after_fork():
+        if Db.__Session is None: return
+        Db.get_instance().dispose(close=False)
+        for metrics in Db.__metrics.values():
+            metrics.reset()
+        if Db.__router is not None: Db.__router.reset()
+        Db.__local = threading.local()
+        Db.__executor = None
+        if Db.__scoped is not None: Db.__scoped = Db.__scoped_sessions()
+
+    def warmup(self, name: str = None) -> int:
+        """Opens and pings ``init_pool_size`` connections of every engine (or of ``name``), returns the count."""
+        opened = 0
+        for engine_name, engine in Db.__engines.items():
+            if name is not None and engine_name != name: continue
+            size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+            connections = []
+            try:
+                for _ in range(size):
+                    connection = engine.connect()
+                    connections.append(connection)
+                    engine.dialect.do_ping(connection.connection.dbapi_connection)
+            finally:
+                for connection in connections:
+                    connection.close()
+            opened += len(connections)
+        logging.debug("Pool warmup opened %s connections in process %s" % (opened, os.getpid()))
+        return opened
+
+    def init_app(self, app):
+        """Scopes sessions to ``app``'s app contexts, initializing ``Db`` first when needed.
+
+        Contexts of other apps, which never tear the sessions down, keep a session per ``Db.get()``.
+        """
+        if Db.__Session is None: self.init()
+        Db.__scoped = Db.__scoped_sessions()
+        if app in Db.__apps: return
+        Db.__apps.add(app)
+        app.after_request(Db.__check_response)
+        app.teardown_appcontext(Db.__teardown)
+
+    @staticmethod
+    def __scoped_sessions():
+        return OrderedDict((name, scoped_session(session, scopefunc=Db.__scope))
+                           for name, session in Db.__sessions.items())
+
+    @staticmethod
+    def __scope():
+        # The context's g itself, not its id: ids are reused once a context is gone
+        return g._get_current_object()
+
+    @staticmethod
+    def __is_scoped() -> bool:
+        return Db.__scoped is not None and has_app_context() and current_app._get_current_object() in Db.__apps
+
+    @staticmethod
+    def __check_response(response):
+        # Controllers turn exceptions into error responses, so teardown sees no exception for them
+        if response.status_code >= 400: g.pyboot_db_failed = True
+        return response
+
+    @staticmethod
+    def __teardown(exception=None):
+        if Db.__scoped is None: return
+        failed = exception is not None or g.get("pyboot_db_failed", False)
+        for name, registry in Db.__scoped.items():
+            if not registry.registry.has(): continue
+            db = registry()
+            try:
+                if not failed:
+                    db.commit()
+                else:
+                    db.rollback()
+            except Exception as e:
+                logging.error("Commit on %s failed at teardown: %s" % (name, e))
+                logging.exception(e)
+                db.rollback()
+            finally:
+                registry.remove()
+
+    def get_engine(self, db_conf: dict = None):
+        if db_conf is None: db_conf = Conf.get("database")
+        if db_conf.get("url"):
+            db_baseurl = db_conf["url"]
+        else:
+            db_baseurl = "mysql://%s/%s?charset=%s&user=%s&passwd=%s" % (
+                db_conf["host"], db_conf["name"], db_conf["charset"], db_conf["user"], db_conf["password"])
         logging.info("DB Baseurl: %s, Init pool size: %s, Max pool size: %s, Pool recycle delay: %s" % (
             db_baseurl, db_conf["init_pool_size"], db_conf["max_pool_size"], db_conf["pool_recycle_delay"]))
-        return create_engine(db_baseurl, echo=db_conf["sql_logging"], poolclass=QueuePool,
+        return create_engine(db_baseurl, echo=db_conf["sql_logging"], poolclass=InstrumentedQueuePool,
                              pool_size=db_conf["init_pool_size"],
                              max_overflow=int(db_conf["max_pool_size"]) - int(db_conf["init_pool_size"]),
-                             pool_recycle=db_conf["pool_recycle_delay"])
+                             pool_recycle=db_conf["pool_recycle_delay"],
+                             pool_pre_ping=db_conf.get("pool_pre_ping", False))
 
-    def __get_session(self):
-        return Db.__Session()
+    def dispose(self, close: bool = True):
+        for engine in Db.__engines.values():
+            engine.dispose(close=close)
 
     @staticmethod
-    def get_db():
-        return Db.get_instance().__get_session()
+    def __merged_conf(db_conf: dict, engine_conf: dict) -> dict:
+        conf = dict((key, value) for key, value in db_conf.items() if key not in ("replicas", "shards", "url"))
+        conf.update(engine_conf)
+        return conf
+
+    @staticmethod
+    def __sessionmaker(name: str, engine, readonly: bool = False, shard: bool = False):
+        # "shard" keeps the model caches of shards apart
+        info = {"db": name, "shard": name} if shard else {"db": name}
+        session = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine, info=info)
+        if name == PRIMARY:
+            event.listen(session, "after_commit", Db.__mark_write)
+            event.listen(session, "after_flush", Db.__mark_write)
+        elif readonly:
+            event.listen(session, "before_flush", Db.__reject_flush)
+        return session
+
+    @staticmethod
+    def __mark_write(session, *args):
+        if has_app_context(): g.pyboot_db_write = True
+        Db.__local.last_write = time.monotonic()
+
+    @staticmethod
+    def __reject_flush(session, flush_context, instances):
+        raise InvalidStateException("Read-only session on %s can not be flushed" % session.info.get("db"))
+
+    @staticmethod
+    def __is_sticky() -> bool:
+        if has_app_context(): return getattr(g, "pyboot_db_write", False)
+        last_write = getattr(Db.__local, "last_write", None)
+        return last_write is not None and time.monotonic() - last_write < Db.__sticky_seconds
+
+    @staticmethod
+    def engine(name: str = PRIMARY):
+        return Db.__engines[name]
+
+    @staticmethod
+    def router() -> ReplicaRouter:
+        return Db.__router
+
+    @staticmethod
+    def shards() -> ShardRouter:
+        return Db.__shards
+
+    @staticmethod
+    def executor() -> ThreadPoolExecutor:
+        """Thread pool for scatter-gather queries, ``shard_workers`` threads (one per shard by default)."""
+        if Db.__executor is None:
+            workers = Conf.get("database").get("shard_workers") or len(Db.__shards.names)
+            Db.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pyboot-shard")
+        return Db.__executor
 
     @staticmethod
     @contextmanager
-    def get():
-        start_time = datetime.datetime.now()
-        db = Db.get_db()
-        logging.debug("Connection time: %s milliseconds" % DatetimeUtil.diff(start_time, datetime.datetime.now()))
+    def shard_sessions():
+        """Yields a session per shard, by shard name, closing them all on exit."""
+        if Db.__shards is None: raise InvalidStateException("No shards configured")
+        dbs = OrderedDict((name, Db.__sessions[name]()) for name in Db.__shards.names)
+        try:
+            yield dbs
+        except:
+            for db in dbs.values():
+                db.rollback()
+            raise
+        finally:
+            for db in dbs.values():
+                db.close()
+
+    @staticmethod
+    def stats() -> dict:
+        """Snapshot of the pool gauges, counters and latency histograms of every engine, by engine name."""
+        return OrderedDict((name, metrics.stats()) for name, metrics in Db.__metrics.items())
+
+    def __get_session(self, readonly: bool = False, shard_key=None):
+        name = PRIMARY
+        if shard_key is not None:
+            if Db.__shards is None: raise InvalidStateException("No shards configured")
+            name = Db.__shards.shard_for(shard_key)
+        elif readonly and Db.__router is not None and not Db.__is_sticky():
+            if not Db.__is_scoped():
+                name = Db.__router.choose() or PRIMARY
+            elif "pyboot_db_replica" in g:
+                name = g.pyboot_db_replica
+            else:
+                name = g.pyboot_db_replica = Db.__router.choose() or PRIMARY
+        if Db.__is_scoped(): return Db.__scoped[name]()
+        return Db.__sessions[name]()
+
+    @staticmethod
+    def get_db(readonly: bool = False, shard_key=None):
+        return Db.get_instance().__get_session(readonly, shard_key)
 
+    @staticmethod
+    @contextmanager
+    def get(readonly: bool = False, shard_key=None):
+        # Checkout waits are timed by InstrumentedQueuePool, nothing is measured or logged per call here
+        scoped = Db.__is_scoped()
+        db = Db.get_db(readonly, shard_key)
         try:
             yield db
         except:
             db.rollback()
             raise
         finally:
-            db.close()
+            if not scoped: db.close()
+
+
+ASYNC_DRIVERS = {"mysql": "aiomysql", "sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+
+class AsyncDb(object):
+    """asyncio counterpart of ``Db`` on the primary of the same ``database`` block.
+
+    The URL is ``async_url`` when set, otherwise ``url`` or the MySQL settings with the driver swapped for
+    its asyncio one (``aiomysql``, ``aiosqlite``, ``asyncpg``). An ``AsyncSession`` runs one statement at a
+    time, so queries meant to run concurrently need a session each. Needs ``greenlet`` and the asyncio driver,
+    which are only imported once ``init`` runs.
+    """
+    __Session = None
+    __instance = None
+    __engine = None
+    __fork_hooks = False
+
+    @staticmethod
+    def get_instance():
+        if AsyncDb.__instance is None:
+            AsyncDb.__instance = AsyncDb()
+        return AsyncDb.__instance
+
+    def init(self):
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        db_conf = Conf.get("database")
+        AsyncDb.__engine = self.get_engine(db_conf)
+        if db_conf.get("query_trace", True): QueryTracer.instrument(AsyncDb.__engine.sync_engine)
+        AsyncDb.__Session = async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                               bind=AsyncDb.__engine)
+        if not AsyncDb.__fork_hooks and hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=AsyncDb.__after_fork)
+            AsyncDb.__fork_hooks = True
+        logging.debug("AsyncDbConfig initialized")
+
+    @staticmethod
+    def __after_fork():
+        if AsyncDb.__engine is not None: AsyncDb.__engine.sync_engine.dispose(close=False)
+
+    def get_engine(self, db_conf: dict = None):
+        from sqlalchemy.ext.asyncio import create_async_engine
+        if db_conf is None: db_conf = Conf.get("database")
+        db_url = AsyncDb.url(db_conf)
+        logging.info("Async DB url: %s, Init pool size: %s, Max pool size: %s, Pool recycle delay: %s" % (
+            db_url.render_as_string(hide_password=True), db_conf["init_pool_size"], db_conf["max_pool_size"],
+            db_conf["pool_recycle_delay"]))
+        return create_async_engine(db_url, echo=db_conf["sql_logging"], pool_size=db_conf["init_pool_size"],
+                                   max_overflow=int(db_conf["max_pool_size"]) - int(db_conf["init_pool_size"]),
+                                   pool_recycle=db_conf["pool_recycle_delay"],
+                                   pool_pre_ping=db_conf.get("pool_pre_ping", False))
+
+    @staticmethod
+    def url(db_conf: dict):
+        if db_conf.get("async_url"): return make_url(db_conf["async_url"])
+        if not db_conf.get("url"):
+            return URL.create("mysql+aiomysql", username=db_conf["user"], password=db_conf["password"],
+                              host=db_conf["host"], database=db_conf["name"], query={"charset": db_conf["charset"]})
+        db_url = make_url(db_conf["url"])
+        backend = db_url.get_backend_name()
+        if backend not in ASYNC_DRIVERS:
+            raise InvalidValueException("No asyncio driver known for '%s', set async_url" % backend)
+        return db_url.set(drivername="%s+%s" % (backend, ASYNC_DRIVERS[backend]))
+
+    @staticmethod
+    def engine():
+        return AsyncDb.__engine
+
+    async def dispose(self):
+        if AsyncDb.__engine is not None: await AsyncDb.__engine.dispose()
+
+    @staticmethod
+    def get_db():
+        return AsyncDb.__Session()
+
+    @staticmethod
+    @asynccontextmanager
+    async def get():
+        db = AsyncDb.get_db()
+        try:
+            yield db
+        except:
+            await db.rollback()
+            raise
+        finally:
+            await db.close()
+
+
+def prometheus_metrics(stats: dict = None) -> str:
+    """Renders ``Db.stats()`` in the Prometheus text exposition format."""
+    if stats is None: stats = Db.stats()
+    gauges = (("checked_out", "Connections checked out of the pool"),
+              ("checked_in", "Idle connections in the pool"),
+              ("overflow", "Connections opened beyond the pool size"),
+              ("pool_size", "Configured pool size"))
+    counters = (("checkouts", "Connection checkouts"),
+                ("connections_created", "DBAPI connections opened"),
+                ("connections_recycled", "DBAPI connections reopened after recycle or invalidation"))
+
+    lines = []
+    for key, doc in gauges:
+        lines += prometheus_lines("pyboot_db_%s" % key, "gauge",
+                                  [({"db": name}, engine_stats[key]) for name, engine_stats in stats.items()
+                                   if engine_stats[key] is not None], doc)
+    for key, doc in counters:
+        lines += prometheus_lines("pyboot_db_%s_total" % key, "counter",
+                                  [({"db": name}, engine_stats[key]) for name, engine_stats in stats.items()], doc)
+    lines += prometheus_lines("pyboot_db_checkout_wait_seconds", "histogram",
+                              [({"db": name}, engine_stats["checkout_wait"])
+                               for name, engine_stats in stats.items()], "Time spent waiting for a connection")
+    lines += prometheus_lines("pyboot_db_statement_seconds", "histogram",
+                              [({"db": name, "statement": statement_type}, histogram)
+                               for name, engine_stats in stats.items()
+                               for statement_type, histogram in sorted(engine_stats["statements"].items())],
+                              "Statement execution time")
+    return "\n".join(lines) + "\n"
+
+
+STREAM_BATCH_SIZE = 1000
+STATEMENT_CACHE_SIZE = 512
+
+FORMAT_DICT = "dict"
+FORMAT_TUPLE = "tuple"
+FORMAT_NAMED = "named"
+FORMAT_COLUMNAR = "columnar"
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _statement(query: str, stream: bool = False):
+    # Reusing one text() construct per SQL template skips re-parsing it and lets SQLAlchemy's compiled
+    # statement cache hit on every call
+    statement = text(query)
+    return statement.execution_options(stream_results=True) if stream else statement
+
+
+@lru_cache(maxsize=256)
+def _named_row(keys: tuple):
+    return namedtuple("Row", keys, rename=True)
+
+
+def _column(values: tuple):
+    if numpy is not None: return numpy.array(values)
+    # Without NumPy, all-int and all-float columns are packed into arrays, anything else stays a list
+    typecode = "q" if all(value.__class__ is int for value in values) else \
+        "d" if all(value.__class__ is float for value in values) else None
+    if typecode is None or not values: return list(values)
+    try:
+        return array.array(typecode, values)
+    except OverflowError:
+        return list(values)
 
 
 class DBQueryHandler(object):
+    """Runs raw SQL. Pass values as bind parameters (``where id = :id`` with ``params={"id": id}``) rather
+    than formatting them into the query: the statement is then parsed and compiled once per template and
+    values are escaped by the driver.
+    """
+
+    @staticmethod
+    def _execute(db, query, params=None, stream=False):
+        if isinstance(query, str):
+            statement = _statement(query, stream)
+        else:
+            statement = query.execution_options(stream_results=True) if stream else query
+        return db.execute(statement, params) if params is not None else db.execute(statement)
+
+    @staticmethod
+    def _format(keys: list, rv: list, format: str):
+        if format == FORMAT_DICT: return [dict(zip(keys, row)) for row in rv]
+        if format == FORMAT_TUPLE: return [tuple(row) for row in rv]
+        if format == FORMAT_NAMED: return list(map(_named_row(tuple(keys))._make, rv))
+        if format == FORMAT_COLUMNAR:
+            columns = list(zip(*rv)) if rv else [()] * len(keys)
+            return dict((key, _column(column)) for key, column in zip(keys, columns))
+        raise InvalidValueException("Invalid result format '%s'" % format)
+
     @staticmethod
-    def get(db, query, one=False):
-        cur = db.execute(query)
+    def get(db, query, one=False, format=FORMAT_DICT, params=None):
+        """Returns the rows of ``query`` as dicts, tuples, named tuples or, with ``FORMAT_COLUMNAR``, a dict of
+        column name to values (NumPy arrays when NumPy is installed, otherwise ``array.array`` for numeric
+        columns and lists for the rest). ``one`` is ignored for the columnar format.
+        """
+        cur = DBQueryHandler._execute(db, query, params)
         rv = cur.fetchall()
+        keys = list(cur.keys())
         cur.close()
-        rows = []
-        for row in rv:
-            rows.append(dict(zip(row.keys(), row)))
+        rows = DBQueryHandler._format(keys, rv, format)
+        if format == FORMAT_COLUMNAR: return rows
 
         return (rows[0] if rows else None) if one else rows
 
     @staticmethod
-    def get_all(db, query, one=False):
-        cur = db.execute(query)
+    def get_all(db, query, one=False, params=None):
+        cur = DBQueryHandler._execute(db, query, params)
         rv = cur.fetchall()
         cur.close()
-        rows = []
-        for row in rv:
-            rows.append(row[0])
+        rows = [row[0] for row in rv]
         return (rows[0] if rows else None) if one else rows
 
     @staticmethod
-    def update(db, query):
-        cur = db.execute(query)
+    def stream(db, query, batch_size=STREAM_BATCH_SIZE, format=FORMAT_DICT, params=None):
+        """Yields the rows of ``query`` one at a time, reading ``batch_size`` rows per fetch."""
+        if format == FORMAT_COLUMNAR: raise InvalidValueException("Columnar results can only be streamed in batches")
+        for rows in DBQueryHandler.stream_batches(db, query, batch_size, format, params):
+            yield from rows
+
+    @staticmethod
+    def stream_batches(db, query, batch_size=STREAM_BATCH_SIZE, format=FORMAT_DICT, params=None):
+        """Yields the rows of ``query`` in batches of up to ``batch_size`` rows, each formatted like ``get``.
+
+        The query runs on a server-side cursor (SSCursor with mysqlclient), so memory is bounded by the
+        batch size. The cursor stays open, holding its connection, until the generator is exhausted or closed.
+        """
+        cur = DBQueryHandler._execute(db, query, params, stream=True)
+        try:
+            keys = list(cur.keys())
+            while True:
+                rv = cur.fetchmany(batch_size)
+                if not rv: break
+                yield DBQueryHandler._format(keys, rv, format)
+        finally:
+            cur.close()
+
+    @staticmethod
+    def update(db, query, params=None):
+        cur = DBQueryHandler._execute(db, query, params)
+        rowcount = cur.rowcount
+        cur.close()
+        return rowcount
+
+    @staticmethod
+    def update_many(db, query, params_list: list):
+        """Runs ``query`` once per dict of ``params_list`` as a single executemany."""
+        if not params_list: return 0
+        cur = DBQueryHandler._execute(db, query, params_list)
+        rowcount = cur.rowcount
         cur.close()
+        return rowcount
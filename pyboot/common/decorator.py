@@ -1,9 +1,10 @@
 import logging
 from functools import wraps
 
-from flask import request
+from flask import make_response, request
 from werkzeug.exceptions import BadRequest
 
+from pyboot.common.database import QueryTracer
 from pyboot.common.exception import NotFoundException, InvalidInputException, InvalidValueException, \
     AccessDeniedException, \
     DuplicateValueException, UnauthorizedException
@@ -30,6 +31,11 @@ class Controller(Decorator):
         def decorator(f):
             @wraps(f)
             def api_response_handler(*args, **kwargs):
+                tracer = QueryTracer.start("%s %s" % (request.method, request.path))
+                response = handle(*args, **kwargs)
+                return tracer.finish(make_response(response)) if tracer else response
+
+            def handle(*args, **kwargs):
                 try:
                     response = f(*args, **kwargs)
                     return response if response else json_response(HttpResponse())
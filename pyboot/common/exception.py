@@ -45,3 +45,13 @@ class AuthenticationFailedException(Exception):
 class MultipleRowsFoundException(Exception):
     def __init__(self, message=None):
         super(MultipleRowsFoundException, self).__init__(message)
+
+
+class QueryBudgetExceededException(Exception):
+    def __init__(self, message=None):
+        super(QueryBudgetExceededException, self).__init__(message)
+
+
+class DeadlineExceededException(Exception):
+    def __init__(self, message=None):
+        super(DeadlineExceededException, self).__init__(message)
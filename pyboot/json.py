@@ -2,6 +2,10 @@ class JSONSerializable(object):
     def to_json_dict(self, include: list = None) -> dict:
         return {}
 
+    @classmethod
+    def to_json_dicts(cls, items: list, include: list = None) -> list:
+        return [item.to_json_dict(include) for item in items]
+
     def from_json_dict(self, json_dict: dict):
         return self
 
@@ -16,3 +20,16 @@ class HttpResponse(JSONSerializable):
         json_dict["code"] = self.code
         json_dict["message"] = self.message
         return json_dict
+
+
+def to_json_list(items: list, include: list = None) -> list:
+    if not items: return []
+
+    # A list of a single class is converted in one batch, anything else item by item
+    cls = items[0].__class__
+    if issubclass(cls, JSONSerializable):
+        for item in items:
+            if item.__class__ is not cls: break
+        else:
+            return cls.to_json_dicts(items, include)
+    return [item.to_json_dict(include) if isinstance(item, JSONSerializable) else item for item in items]
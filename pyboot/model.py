@@ -1,3 +1,11 @@
+import datetime
+import heapq
+import itertools
+import logging
+import time
+import uuid
+from typing import TYPE_CHECKING
+
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import Date
@@ -5,15 +13,34 @@ from sqlalchemy import DateTime
 from sqlalchemy import Float
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import event
 from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Query
 from sqlalchemy.orm import RelationshipProperty
 from sqlalchemy.orm import Session
-
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+from pyboot.common.exception import InvalidValueException
 from pyboot.json import JSONSerializable
+from pyboot.page import PageCursor
+from pyboot.util.cache import CacheBackend, LRUCache, SingleFlight
 from pyboot.util.common import Parser, DatetimeUtil, Validator, DateUtil
 
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
 TYPE_INT = "int"
 TYPE_FLOAT = "float"
 TYPE_BOOL = "bool"
@@ -25,14 +52,328 @@ TYPE_LIST = "list"
 TYPE_OBJ = "obj"
 TYPE_UNKNOWN = "unknown"
 
+# Ids per IN (...) query, small enough to stay well within MySQL's max_allowed_packet
+IN_CLAUSE_CHUNK_SIZE = 1000
+BULK_BATCH_SIZE = 1000
+LOAD_OPTIONS_CACHE_SIZE = 256
+# Dialects sorting NULLs above every value; the others (MySQL, SQLite, SQL Server) sort them below
+NULLS_HIGH_DIALECTS = frozenset(("postgresql", "oracle"))
+
+# Session.info key of the cache invalidations to repeat once the transaction ends
+CACHE_INVALIDATIONS = "pyboot_cache_invalidations"
+
+_MISSING = object()
+
+
+def _str(value):
+    return value if value.__class__ is str and value else Parser.str(value)
+
+
+def _int(value):
+    return value if value.__class__ is int else Parser.int(value)
+
+
+def _float(value):
+    return value if value.__class__ is float else Parser.float(value)
+
+
+def _bool(value):
+    return value if value.__class__ is bool else Parser.bool(value)
+
+
+def _datetime(value):
+    if value.__class__ is datetime.datetime: return value
+    if isinstance(value, str): return DatetimeUtil.iso_to_dt_local(value)
+    return Validator.datetime(value)
+
+
+def _date(value):
+    if value.__class__ is datetime.date: return value
+    if isinstance(value, str): return DateUtil.iso_to_date(value)
+    return Validator.date(value)
+
+
+def _obj_to_dict(value):
+    return value.to_json_dict() if isinstance(value, Model) else value
+
+
+def _obj_from_dict(value):
+    return value.from_json_dict() if isinstance(value, Model) else value
+
+
+def _list(value):
+    # Same as the TYPE_LIST branch of _to_dict_field: the last item wins and an empty list sets nothing
+    result = _MISSING
+    for value_item in value:
+        result = value_item.to_json_dict() if isinstance(value_item, Model) else value_item
+    return result
+
+
+_TO_DICT_CONVERTERS = {
+    TYPE_STR: _str,
+    TYPE_INT: _int,
+    TYPE_FLOAT: _float,
+    TYPE_BOOL: _bool,
+    TYPE_DATETIME: _datetime,
+    TYPE_DATE: _date,
+    TYPE_OBJ: _obj_to_dict,
+    TYPE_LIST: _list,
+}
+
+_FROM_DICT_CONVERTERS = dict(_TO_DICT_CONVERTERS)
+_FROM_DICT_CONVERTERS[TYPE_OBJ] = _obj_from_dict
+
+
+class ModelSerializer(object):
+    """Field plan of a model class, built once from its ``_get_fields()``.
+
+    Each field is paired with the converter for its type, so serializing a row is a single pass over
+    the plan instead of the ``_to_dict_field``/``_from_dict_field`` type dispatch. Output is the same.
+    """
+
+    def __init__(self, fields: dict = None):
+        if not fields: fields = {}
+        self.to_dict_plan = [(name, _TO_DICT_CONVERTERS.get(type)) for name, type in fields.items() if name]
+        self.from_dict_plan = [(name, _FROM_DICT_CONVERTERS.get(type)) for name, type in fields.items() if name]
+        self.obj_fields = [name for name, type in fields.items() if type == TYPE_OBJ]
+
+    def to_dict(self, model) -> dict:
+        obj_dict = {}
+        if model.id: obj_dict["id"] = model.id
+
+        values = model.__dict__
+        for name, converter in self.to_dict_plan:
+            if name not in values: continue
+            if converter is None:
+                obj_dict[name] = values[name]
+            else:
+                value = converter(values[name])
+                if value is not _MISSING: obj_dict[name] = value
+        return obj_dict
+
+    def to_dicts(self, models: list) -> list:
+        obj_dicts = []
+        rows = []
+        for model in models:
+            obj_dict = {}
+            if model.id: obj_dict["id"] = model.id
+            obj_dicts.append(obj_dict)
+            rows.append((obj_dict, model.__dict__))
+
+        # Column by column, so every row still gets its keys in field order
+        for name, converter in self.to_dict_plan:
+            if converter is None:
+                for obj_dict, values in rows:
+                    if name in values: obj_dict[name] = values[name]
+            else:
+                for obj_dict, values in rows:
+                    if name not in values: continue
+                    value = converter(values[name])
+                    if value is not _MISSING: obj_dict[name] = value
+        return obj_dicts
+
+    def include_objs(self, models: list, json_dicts: list, include: list = None):
+        if not include: include = []
+        for name in self.obj_fields:
+            included = name in include
+            field_name = name + "_id"
+            for model, json_dict in zip(models, json_dicts):
+                sub_obj = getattr(model, name, None) if included else None
+                value = getattr(model, field_name, None)
+                if sub_obj:
+                    if isinstance(sub_obj, Model): json_dict[name] = sub_obj.to_dict()
+                elif value:
+                    json_dict[name] = {"id": value}
+                elif included:
+                    json_dict[name] = None
+
+                if field_name in json_dict: del json_dict[field_name]
+        return json_dicts
+
+    def from_dict(self, model, obj_dict: dict):
+        for name, converter in self.from_dict_plan:
+            if name not in obj_dict: continue
+            if converter is None:
+                setattr(model, name, obj_dict[name])
+            else:
+                value = converter(obj_dict[name])
+                if value is not _MISSING: setattr(model, name, value)
+        return model
+
+    def coerce(self, obj_dict: dict) -> dict:
+        """Returns the values ``from_dict`` would set for ``obj_dict``, without a model instance."""
+        values = {}
+        for name, converter in self.from_dict_plan:
+            if name not in obj_dict: continue
+            if converter is None:
+                values[name] = obj_dict[name]
+            else:
+                value = converter(obj_dict[name])
+                if value is not _MISSING: values[name] = value
+        return values
+
+
+class BulkResult(object):
+    def __init__(self, operation: str, table: str):
+        self.operation = operation
+        self.table = table
+        self.rows = 0
+        self.batches = 0
+        self.time_ms = 0.0
+        self.__start = time.perf_counter()
+
+    def add_batch(self, rows: int):
+        self.rows += rows
+        self.batches += 1
+
+    def done(self):
+        self.time_ms = (time.perf_counter() - self.__start) * 1000
+        logging.debug("Bulk %s on %s: %s rows in %s batches, %.1f milliseconds",
+                      self.operation, self.table, self.rows, self.batches, self.time_ms)
+        return self
+
+
+class ModelCache(object):
+    """Read-through cache of one model class, configured by its ``__cache__`` attribute.
+
+    Rows are stored as column values and attached to the caller's session on a hit. ``get`` entries are
+    keyed by id and ``get_all`` entries by their arguments under a generation token, so any write to the
+    class drops its lists at once. With ``single_flight`` (``True`` or a shared ``SingleFlight``), concurrent
+    ``get`` misses of one id run a single query and the other threads attach its row to their own session.
+    Sessions whose ``info`` names a ``shard`` (as ``Db`` sets on shard sessions) get entries of their own.
+    """
+
+    def __init__(self, model_class, ttl: float = 60, max_entries: int = 10000, backend: CacheBackend = None,
+                 single_flight=False):
+        self.ttl = ttl
+        self.backend = backend if backend is not None else LRUCache(max_entries=max_entries)
+        self.flight = SingleFlight() if single_flight is True else single_flight or None
+        self.hits = 0
+        self.misses = 0
+        self.__mapper = inspect(model_class)
+        self.__keys = [prop.key for prop in self.__mapper.column_attrs]
+        self.__prefix = "pyboot:%s" % model_class.__tablename__
+
+    def get(self, db: Session, id, load):
+        namespace = self.__namespace(db.info.get("shard"))
+        key = "%s:get:%s:%s" % (namespace, self.__generation(namespace, "rows"), id)
+        values = self.backend.get(key)
+        if values is not None:
+            self.hits += 1
+            return self.__attach(db, values)
+
+        self.misses += 1
+        if self.flight is not None: return self.__get_single_flight(db, key, load)
+        obj = load()
+        if obj is not None and self.__is_clean(obj): self.backend.set(key, self.__values(obj), self.ttl)
+        return obj
+
+    def __get_single_flight(self, db: Session, key: str, load):
+        loaded = []
+
+        def load_values():
+            obj = load()
+            loaded.append(obj)
+            if obj is None: return None
+            if not self.__is_clean(obj): return _MISSING
+            values = self.__values(obj)
+            self.backend.set(key, values, self.ttl)
+            return values
+
+        values = self.flight.do(key, load_values)
+        if loaded: return loaded[0]
+        if values is _MISSING: return load()
+        return self.__attach(db, values) if values is not None else None
+
+    def get_all(self, db: Session, params: tuple, load) -> list:
+        namespace = self.__namespace(db.info.get("shard"))
+        key = "%s:all:%s:%s:%r" % (namespace, self.__generation(namespace, "rows"),
+                                   self.__generation(namespace, "lists"), params)
+        rows = self.backend.get(key)
+        if rows is not None:
+            self.hits += 1
+            return [self.__attach(db, values) for values in rows]
+
+        self.misses += 1
+        items = load()
+        if all(self.__is_clean(item) for item in items):
+            self.backend.set(key, [self.__values(item) for item in items], self.ttl)
+        return items
+
+    def invalidate(self, db: Session = None, id=None, shard=None):
+        """Drops the entry of ``id`` (every row when ``None``) and all lists, of ``db``'s shard if any.
+
+        With a session, the invalidation is repeated when its transaction commits or rolls back, so a
+        concurrent read can't keep data from before the write.
+        """
+        if db is not None: shard = db.info.get("shard")
+        namespace = self.__namespace(shard)
+        if id is None:
+            self.__new_generation(namespace, "rows")
+        else:
+            self.backend.delete("%s:get:%s:%s" % (namespace, self.__generation(namespace, "rows"), id))
+        self.__new_generation(namespace, "lists")
+        if db is not None: db.info.setdefault(CACHE_INVALIDATIONS, set()).add((self, id, shard))
+
+    def stats(self) -> dict:
+        stats = {"hits": self.hits, "misses": self.misses, "backend": self.backend.stats()}
+        if self.flight is not None: stats["single_flight"] = self.flight.stats()
+        return stats
+
+    def __namespace(self, shard) -> str:
+        return self.__prefix if shard is None else "%s:%s" % (self.__prefix, shard)
+
+    def __generation(self, namespace: str, name: str) -> str:
+        key = "%s:generation:%s" % (namespace, name)
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = self.__new_generation(namespace, name)
+        return generation
+
+    def __new_generation(self, namespace: str, name: str) -> str:
+        generation = uuid.uuid4().hex
+        self.backend.set("%s:generation:%s" % (namespace, name), generation, 0)
+        return generation
+
+    def __values(self, obj) -> dict:
+        values = obj.__dict__
+        return dict((key, values[key]) for key in self.__keys if key in values)
+
+    def __attach(self, db: Session, values: dict):
+        obj = db.identity_map.get(self.__mapper.identity_key_from_primary_key([values["id"]]))
+        if obj is not None: return obj
+
+        obj = self.__mapper.class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(obj, key, value)
+        make_transient_to_detached(obj)
+        db.add(obj)
+        return obj
+
+    @staticmethod
+    def __is_clean(obj) -> bool:
+        # Pending or modified rows are not what the database holds for other sessions
+        state = inspect(obj)
+        return state.persistent and not state.modified
+
 
 class Model(JSONSerializable):
     _fields = None
+    _serializer = None
 
     @classmethod
     def _get_fields(cls):
         return cls._fields
 
+    @classmethod
+    def _get_serializer(cls) -> ModelSerializer:
+        # Looked up in the class __dict__ so that subclasses never share their parent's plan
+        serializer = cls.__dict__.get("_serializer")
+        if serializer is None:
+            serializer = ModelSerializer(cls._get_fields())
+            cls._serializer = serializer
+        return serializer
+
     def _to_dict_field(self, obj_dict, name: str, type: str = None):
         if not name or name not in self.__dict__: return
         value = getattr(self, name)
@@ -107,46 +448,56 @@ class Model(JSONSerializable):
         else:
             setattr(self, name, value)
 
+    @classmethod
+    def _overrides(cls, name: str) -> bool:
+        return getattr(cls, name) is not getattr(Model, name)
+
     def to_dict(self):
+        # Subclasses customising the per-field conversion keep their own per-field behaviour
+        cls = self.__class__
+        if not cls._overrides("_to_dict_field"): return cls._get_serializer().to_dict(self)
+
         obj_dict = {}
         if self.id: obj_dict["id"] = self.id
-
-        fields = self.__class__._get_fields()
+        fields = cls._get_fields()
         if not fields: return obj_dict
         for field_name in fields.keys():
             self._to_dict_field(obj_dict, field_name, fields[field_name])
-
         return obj_dict
 
     def from_dict(self, obj_dict: dict):
         if not obj_dict: return
         if "id" in obj_dict: self.id = obj_dict["id"]
 
-        fields = self.__class__._get_fields()
+        cls = self.__class__
+        if not cls._overrides("_from_dict_field"): return cls._get_serializer().from_dict(self, obj_dict)
+        fields = cls._get_fields()
         if not fields: return self
         for field_name in fields:
             self._from_dict_field(obj_dict, field_name, fields[field_name])
-
         return self
 
     def to_json_dict(self, include: list = None) -> dict:
         json_dict = self.to_dict()
 
-        fields = self.__class__._get_fields()
-        if not fields: return json_dict
-        for field_name in fields.keys():
-            if fields[field_name] == TYPE_OBJ:
-                self._include_obj(json_dict, include, field_name)
+        for field_name in self.__class__._get_serializer().obj_fields:
+            self._include_obj(json_dict, include, field_name)
         return json_dict
 
+    @classmethod
+    def to_json_dicts(cls, models: list, include: list = None) -> list:
+        # Subclasses that customise serialization keep their own per-row behaviour
+        if any(cls._overrides(name) for name in ("to_json_dict", "to_dict", "_to_dict_field", "_include_obj")):
+            return super().to_json_dicts(models, include)
+
+        serializer = cls._get_serializer()
+        return serializer.include_objs(models, serializer.to_dicts(models), include)
+
     def from_json_dict(self, json_dict: dict):
         self.from_dict(json_dict)
 
-        fields = self.__class__._get_fields()
-        if not fields: return self
-        for field_name in fields:
-            if fields[field_name] == TYPE_OBJ:
-                self._exclude_obj(json_dict, field_name)
+        for field_name in self.__class__._get_serializer().obj_fields:
+            self._exclude_obj(json_dict, field_name)
         return self
 
     def _include_obj(self, json_dict: dict, include: list, name: str):
@@ -212,30 +563,362 @@ class DatabaseModel(Model):
 
     @classmethod
     def _query(cls, query: Query, start: int = None, count: int = None, order_by=None) -> Query:
+        if order_by is not None: query = query.order_by(order_by)
         if start: query = query.offset(start)
         if count: query = query.limit(count)
-        if order_by is not None: query = query.order_by(order_by)
         return query
 
     @classmethod
-    def get_all(cls, db: Session, start: int = None, count: int = None, order_by=None, include: list = None) -> list:
-        query = cls._query(db.query(cls), start=start, count=count, order_by=order_by)
-        cls.join_tables(query, include)
-        return query.all()
+    def _order_column(cls, order_by=None):
+        if order_by is None: return cls.id, False
+        if isinstance(order_by, UnaryExpression) and order_by.modifier in (operators.asc_op, operators.desc_op):
+            return order_by.element, order_by.modifier is operators.desc_op
+        return order_by, False
+
+    @classmethod
+    def _keyset_queries(cls, query: Query, order_by=None, cursor: str = None):
+        """Returns the queries reading the rows after ``cursor`` in keyset order, to run one after the other.
+
+        Each one is a range on (order column, id) ordered like the index, using the database's own NULL order;
+        rows with a NULL order column are read by a query of their own rather than by an ``OR``, which would
+        keep the database from walking the index.
+        """
+        column, desc = cls._order_column(order_by)
+        by_id = column.key == "id"
+        backward = False
+        values = None
+        if cursor:
+            direction, values = PageCursor.decode(cursor)
+            if len(values) != (1 if by_id else 2): raise InvalidValueException("Invalid page cursor '%s'" % cursor)
+            backward = direction == PageCursor.PREV
+            # Walking back to the previous page reads the same order in reverse
+            desc = desc != backward
+
+        order = [cls.id] if by_id else [column, cls.id]
+        query = query.order_by(*[item.desc() if desc else item.asc() for item in order])
+        if values is None: return [query], backward
+        after_id = cls.id < values[-1] if desc else cls.id > values[-1]
+        if by_id: return [query.filter(after_id)], backward
+
+        value = values[0]
+        nulls_after = desc == cls._nulls_low(query.session)
+        if value is None:
+            nulls = query.filter(column.is_(None), after_id)
+            return ([nulls] if nulls_after else [nulls, query.filter(column.isnot(None))]), backward
+        if desc:
+            seek = and_(column <= value, or_(column < value, after_id))
+        else:
+            seek = and_(column >= value, or_(column > value, after_id))
+        queries = [query.filter(seek)]
+        if nulls_after and cls._is_nullable(column): queries.append(query.filter(column.is_(None)))
+        return queries, backward
+
+    @classmethod
+    def _nulls_low(cls, db: Session) -> bool:
+        return db.get_bind(mapper=cls).dialect.name not in NULLS_HIGH_DIALECTS
+
+    @staticmethod
+    def _is_nullable(column) -> bool:
+        return getattr(getattr(column, "expression", column), "nullable", True)
+
+    @classmethod
+    def cursor_key(cls, order_by=None):
+        """Returns the function that gives a row's keyset cursor values for ``order_by``."""
+        key = cls._order_column(order_by)[0].key
+        if key == "id": return lambda item: [item.id]
+        return lambda item: [getattr(item, key), item.id]
+
+    @classmethod
+    def get_all(cls, db: Session, start: int = None, count: int = None, order_by=None, include: list = None,
+                cursor: str = None, keyset: bool = False) -> list:
+        """Returns rows by ``start``/``count`` offset, or by keyset when ``keyset`` or ``cursor`` is given.
+
+        Keyset mode seeks on ``order_by`` (a column or ``column.asc()``/``column.desc()``) with ``id`` as the
+        tiebreaker, so every page costs the same as the first given an index on (order column, id).
+        """
+        cache = cls._get_cache()
+        if cache is not None and not include:
+            params = (start, count, None if order_by is None else str(order_by), cursor, keyset)
+            return cache.get_all(db, params, lambda: cls._get_all(db, start, count, order_by, None, cursor, keyset))
+        return cls._get_all(db, start, count, order_by, include, cursor, keyset)
+
+    @classmethod
+    def get_all_sharded(cls, dbs: list, start: int = None, count: int = None, order_by=None, include: list = None,
+                        executor=None) -> list:
+        """``get_all`` over one session per shard, merged in ``order_by`` order (then ``id``) and paginated.
+
+        Each shard reads its first ``start + count`` rows by keyset order, in parallel on ``executor`` (a
+        ``concurrent.futures`` executor) when given; ``id`` is assumed unique across shards.
+        """
+        limit = (start or 0) + count if count else None
+        fetch = lambda db: cls.get_all(db, count=limit, order_by=order_by, include=include, keyset=True)
+        results = list(executor.map(fetch, dbs)) if executor is not None else [fetch(db) for db in dbs]
+        cursor_key = cls.cursor_key(order_by)
+        # NULLs sort as in each shard's keyset order
+        nulls_low = cls._nulls_low(dbs[0]) if dbs else True
+        merge_key = lambda item: [((value is None) != nulls_low, value) for value in cursor_key(item)]
+        merged = heapq.merge(*results, key=merge_key, reverse=cls._order_column(order_by)[1])
+        return list(itertools.islice(merged, start or 0, limit))
+
+    @classmethod
+    def _get_all(cls, db: Session, start: int, count: int, order_by, include: list, cursor: str, keyset: bool) -> list:
+        if not keyset and not cursor:
+            query = cls._query(db.query(cls), start=start, count=count, order_by=order_by)
+            return cls.join_tables(query, include).all()
+        queries, backward = cls._keyset_queries(db.query(cls), order_by=order_by, cursor=cursor)
+        items = []
+        for query in queries:
+            if count and len(items) >= count: break
+            query = cls.join_tables(query, include)
+            items += query.limit(count - len(items)).all() if count else query.all()
+        if backward: items.reverse()
+        return items
 
     @classmethod
     def get(cls, db: Session, id: int, include: list = None):
+        cache = cls._get_cache()
+        if cache is not None and not include:
+            return cache.get(db, id, lambda: db.query(cls).get(id))
+
         query = db.query(cls)  # type: Query
         query = cls.join_tables(query, include)
         return query.get(id)
 
+    @classmethod
+    def _get_cache(cls) -> ModelCache:
+        """Returns the class's cache when it sets ``__cache__ = {"ttl": ..., "max_entries": ..., "backend": ...}``.
+
+        Lookups with ``include`` always read the database: cached rows don't carry relationships, and writes
+        to related models would not invalidate them.
+        """
+        cache = cls.__dict__.get("_model_cache", _MISSING)
+        if cache is _MISSING:
+            config = getattr(cls, "__cache__", None)
+            cache = cls._model_cache = ModelCache(cls, **config) if config else None
+        return cache
+
+    @classmethod
+    def cache_stats(cls) -> dict:
+        cache = cls._get_cache()
+        return cache.stats() if cache is not None else {}
+
+    @classmethod
+    def get_many(cls, db: Session, ids: list, include: list = None, keep_missing: bool = False,
+                 chunk_size: int = IN_CLAUSE_CHUNK_SIZE) -> list:
+        """Returns the rows for ``ids`` in input order, with ``None`` for misses when ``keep_missing`` is set.
+
+        Rows already in the session are reused; the rest are read with chunked ``IN`` queries.
+        """
+        if not ids: return []
+        mapper = inspect(cls)
+        found = {}
+        missing = []
+        for id in dict.fromkeys(ids):
+            obj = db.identity_map.get(mapper.identity_key_from_primary_key([id]))
+            if obj is not None:
+                found[id] = obj
+            else:
+                missing.append(id)
+
+        for index in range(0, len(missing), chunk_size):
+            query = db.query(cls).filter(cls.id.in_(missing[index:index + chunk_size]))
+            for obj in cls.join_tables(query, include):
+                found[obj.id] = obj
+
+        if keep_missing: return [found.get(id) for id in ids]
+        return [found[id] for id in ids if id in found]
+
+    @classmethod
+    async def get_async(cls, db: "AsyncSession", id: int, include: list = None):
+        """``get`` on an ``AsyncSession``; give each coroutine run with ``asyncio.gather`` its own session."""
+        return await db.run_sync(lambda session: cls.get(session, id, include))
+
+    @classmethod
+    async def get_all_async(cls, db: "AsyncSession", start: int = None, count: int = None, order_by=None,
+                            include: list = None, cursor: str = None, keyset: bool = False) -> list:
+        return await db.run_sync(lambda session: cls.get_all(session, start, count, order_by, include, cursor, keyset))
+
+    @classmethod
+    async def get_many_async(cls, db: "AsyncSession", ids: list, include: list = None, keep_missing: bool = False,
+                             chunk_size: int = IN_CLAUSE_CHUNK_SIZE) -> list:
+        return await db.run_sync(lambda session: cls.get_many(session, ids, include, keep_missing, chunk_size))
+
     @classmethod
     def delete(cls, db: Session, id: int):
         db.query(cls).filter(cls.id == id).delete()
+        cls._invalidate_cache(db, id)
+
+    @classmethod
+    def _invalidate_cache(cls, db: Session, id=None):
+        cache = cls._get_cache()
+        if cache is not None: cache.invalidate(db, id)
+
+    @classmethod
+    def delete_many(cls, db: Session, ids: list, batch_size: int = IN_CLAUSE_CHUNK_SIZE) -> BulkResult:
+        result = BulkResult("delete", cls.__tablename__)
+        ids = list(dict.fromkeys(ids))
+        for index in range(0, len(ids), batch_size):
+            result.add_batch(db.query(cls).filter(cls.id.in_(ids[index:index + batch_size])).delete())
+        cls._invalidate_cache(db)
+        return result.done()
+
+    @classmethod
+    def bulk_insert(cls, db: Session, rows: list, batch_size: int = BULK_BATCH_SIZE) -> BulkResult:
+        """Inserts dicts or models with executemany, ``batch_size`` rows per statement.
+
+        Dicts are coerced the way ``from_dict`` does. The session is not flushed or committed.
+        """
+        result = BulkResult("insert", cls.__tablename__)
+        for batch in cls._bulk_batches(rows, batch_size):
+            db.execute(cls.__table__.insert(), batch)
+            result.add_batch(len(batch))
+        cls._invalidate_cache(db)
+        return result.done()
+
+    @classmethod
+    def bulk_upsert(cls, db: Session, rows: list, conflict_keys: list, update_fields: list = None,
+                    batch_size: int = BULK_BATCH_SIZE) -> BulkResult:
+        """Inserts rows, updating ``update_fields`` (default: all given) where ``conflict_keys`` already exist.
+
+        MySQL gets one multi-row ``INSERT ... ON DUPLICATE KEY UPDATE`` per batch, which matches on any
+        unique key. Other dialects look up the existing keys and issue an executemany UPDATE and INSERT.
+        """
+        if not conflict_keys: raise InvalidValueException("Conflict keys are required for upsert")
+        result = BulkResult("upsert", cls.__tablename__)
+        is_mysql = db.get_bind(mapper=inspect(cls)).dialect.name == "mysql"
+        for batch in cls._bulk_batches(rows, batch_size):
+            fields = [key for key in batch[0]
+                      if key not in conflict_keys and (not update_fields or key in update_fields)]
+            if is_mysql:
+                db.execute(cls._mysql_upsert(batch, conflict_keys, fields))
+            else:
+                cls._upsert_batch(db, batch, conflict_keys, fields)
+            result.add_batch(len(batch))
+        cls._invalidate_cache(db)
+        return result.done()
+
+    @classmethod
+    def _mysql_upsert(cls, batch: list, conflict_keys: list, fields: list):
+        statement = mysql_insert(cls.__table__).values(batch)
+        if fields: return statement.on_duplicate_key_update({key: statement.inserted[key] for key in fields})
+        # Nothing to update: a no-op assignment keeps existing rows as they are, unlike INSERT IGNORE which
+        # would also hide other errors
+        key = conflict_keys[0]
+        return statement.on_duplicate_key_update({key: cls.__table__.c[key]})
+
+    @classmethod
+    def _upsert_batch(cls, db: Session, batch: list, conflict_keys: list, fields: list):
+        table = cls.__table__
+        for row in batch:
+            if any(key not in row for key in conflict_keys):
+                raise InvalidValueException("Upsert row is missing conflict keys %s" % conflict_keys)
+        # The last row wins when a batch repeats a key
+        rows = dict((tuple(row[key] for key in conflict_keys), row) for row in batch)
+
+        key_columns = [table.c[key] for key in conflict_keys]
+        if len(key_columns) == 1:
+            where = key_columns[0].in_([key[0] for key in rows])
+        else:
+            where = tuple_(*key_columns).in_(list(rows))
+        existing = set(tuple(row) for row in db.execute(select(*key_columns).where(where)))
+
+        updates = [row for key, row in rows.items() if key in existing]
+        inserts = [row for key, row in rows.items() if key not in existing]
+        if updates and fields:
+            statement = table.update() \
+                .where(and_(*[table.c[key] == bindparam("_key_" + key) for key in conflict_keys])) \
+                .values({key: bindparam("_value_" + key) for key in fields})
+            params = []
+            for row in updates:
+                param = dict(("_key_" + key, row[key]) for key in conflict_keys)
+                param.update(("_value_" + key, row[key]) for key in fields)
+                params.append(param)
+            db.execute(statement, params)
+        if inserts:
+            db.execute(table.insert(), inserts)
+
+    @classmethod
+    def _bulk_batches(cls, rows: list, batch_size: int):
+        serializer = cls._get_serializer()
+        columns = [(prop.key, prop.columns[0].key) for prop in inspect(cls).column_attrs]
+        batch = []
+        batch_keys = None
+        for row in rows:
+            values = serializer.coerce(row) if isinstance(row, dict) else row.__dict__
+            row = dict((column, values[key]) for key, column in columns if key in values)
+            # executemany needs the same columns in every row of a batch
+            if batch and (len(batch) >= batch_size or row.keys() != batch_keys):
+                yield batch
+                batch = []
+            batch.append(row)
+            batch_keys = row.keys()
+        if batch: yield batch
 
     @classmethod
     def join_tables(cls, query: Query, include: list = None) -> Query:
-        return query
+        """Eager loads the relationships named in ``include``, e.g. ``["person", "clients.person"]``."""
+        if not include: return query
+        options = cls._get_load_options(tuple(include))
+        return query.options(*options) if options else query
+
+    @classmethod
+    def _get_load_options(cls, include: tuple) -> list:
+        # Loader options don't depend on the query, so they are built once per class and set of relationship
+        # paths; unknown names are dropped first so request input can't grow the cache
+        cache = cls.__dict__.get("_load_options")
+        if cache is None:
+            cache = cls._load_options = LRUCache(max_entries=LOAD_OPTIONS_CACHE_SIZE)
+        paths = cls._relationship_paths(include)
+        options = cache.get(paths)
+        if options is not None: return options
+
+        options = []
+        for path in paths:
+            option = None
+            mapper = inspect(cls)
+            for name in path:
+                relation = mapper.relationships[name]
+                # Many-to-one rows are joined in; collections are loaded with one extra IN query
+                if relation.direction.name == "MANYTOONE" or not relation.uselist:
+                    loader = joinedload if option is None else option.joinedload
+                else:
+                    loader = selectinload if option is None else option.selectinload
+                option = loader(getattr(mapper.class_, name))
+                mapper = relation.mapper
+            options.append(option)
+
+        cache.set(paths, options)
+        return options
+
+    @classmethod
+    def _relationship_paths(cls, include: tuple) -> tuple:
+        """The relationship prefixes of ``include`` paths, as sorted unique name tuples."""
+        paths = set()
+        for path in include:
+            names = []
+            mapper = inspect(cls)
+            for name in path.split("."):
+                relation = mapper.relationships.get(name)
+                if relation is None: break
+                names.append(name)
+                mapper = relation.mapper
+            if names: paths.add(tuple(names))
+        return tuple(sorted(paths))
 
 
 DatabaseModelBase = declarative_base(cls=DatabaseModel)
+
+
+def _invalidate_flushed(session: Session, flush_context):
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, DatabaseModel): obj.__class__._invalidate_cache(session, obj.id)
+
+
+def _invalidate_ended(session: Session, *args):
+    for cache, id, shard in session.info.pop(CACHE_INVALIDATIONS, ()):
+        cache.invalidate(id=id, shard=shard)
+
+
+event.listen(Session, "after_flush", _invalidate_flushed)
+event.listen(Session, "after_commit", _invalidate_ended)
+event.listen(Session, "after_rollback", _invalidate_ended)
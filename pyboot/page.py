@@ -1,4 +1,59 @@
-from json import JSONSerializable
+import base64
+import datetime
+import json
+
+import iso8601
+from sqlalchemy import func
+from sqlalchemy.orm import Query
+
+from pyboot.common.conf import API_MAX_RECORDS
+from pyboot.common.exception import InvalidValueException
+from pyboot.json import JSONSerializable, to_json_list
+from pyboot.util.cache import LRUCache
+
+COUNT_EXACT = "exact"
+COUNT_CACHED = "cached"
+COUNT_ESTIMATED = "estimated"
+
+# Oldest server versions with window functions, by dialect name
+WINDOW_FUNCTION_VERSIONS = {"sqlite": (3, 25), "mysql": (8, 0), "mariadb": (10, 2), "postgresql": (),
+                            "mssql": (), "oracle": ()}
+
+_count_cache = LRUCache(max_entries=1000)
+
+
+class PageCursor(object):
+    """Opaque keyset cursor: the page direction plus the order values of the row to seek from."""
+    NEXT = "n"
+    PREV = "p"
+
+    @staticmethod
+    def encode(direction: str, values: list) -> str:
+        data = [direction] + [PageCursor.__encode_value(value) for value in values]
+        cursor = base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        return cursor.decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode(cursor: str):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+            if not isinstance(data, list) or len(data) < 2 or data[0] not in (PageCursor.NEXT, PageCursor.PREV):
+                raise ValueError(cursor)
+            return data[0], [PageCursor.__decode_value(value) for value in data[1:]]
+        except (ValueError, TypeError, KeyError, iso8601.ParseError):
+            raise InvalidValueException("Invalid page cursor '%s'" % cursor)
+
+    @staticmethod
+    def __encode_value(value):
+        if isinstance(value, datetime.datetime): return {"dt": value.isoformat()}
+        if isinstance(value, datetime.date): return {"d": value.isoformat()}
+        return value
+
+    @staticmethod
+    def __decode_value(value):
+        if not isinstance(value, dict): return value
+        if "dt" in value: return iso8601.parse_date(value["dt"], default_timezone=None)
+        return datetime.datetime.strptime(value["d"], "%Y-%m-%d").date()
 
 
 class Page(JSONSerializable):
@@ -17,7 +72,88 @@ class Page(JSONSerializable):
         self.next_page_count = None
         self.next_page_url = None
 
-    def gen_page_data(self, start: int, count: int):
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    @classmethod
+    def from_query(cls, query: Query, start: int = 0, count: int = API_MAX_RECORDS, total: str = COUNT_EXACT,
+                   count_ttl: float = 60):
+        """Builds a page from an ordered query, fetching ``count + 1`` rows.
+
+        ``total`` chooses how ``total_count`` is filled: ``COUNT_EXACT`` reads it with the rows through a
+        ``COUNT(*) OVER ()`` column where the dialect supports it (a separate count query otherwise),
+        ``COUNT_CACHED`` does the same but keeps the count for ``count_ttl`` seconds per filter, and
+        ``COUNT_ESTIMATED`` skips counting and leaves ``total_count`` as ``None``.
+        """
+        if not start: start = 0
+        page = cls()
+        if total == COUNT_ESTIMATED:
+            page.items = query.offset(start).limit(count + 1).all()
+            page.total_count = None
+        elif total == COUNT_CACHED:
+            key = Page.__count_key(query)
+            page.total_count = _count_cache.get(key)
+            if page.total_count is None:
+                page.items, page.total_count = Page.__fetch_with_count(query, start, count)
+                _count_cache.set(key, page.total_count, count_ttl)
+            else:
+                page.items = query.offset(start).limit(count + 1).all()
+        else:
+            page.items, page.total_count = Page.__fetch_with_count(query, start, count)
+
+        page.gen_page_data(start, count)
+        return page
+
+    @staticmethod
+    def __fetch_with_count(query: Query, start: int, count: int):
+        if not Page.__window_count_supported(query) or Page.__is_distinct(query):
+            return query.offset(start).limit(count + 1).all(), query.order_by(None).count()
+
+        # A single entity comes back as itself, anything else as a row, like query.all()
+        descriptions = query.column_descriptions
+        single = len(descriptions) == 1 and descriptions[0]["expr"] is descriptions[0]["entity"]
+        rows = query.add_columns(func.count().over()).offset(start).limit(count + 1).all()
+        if not rows:
+            # Past the last row there is nothing to read the count from
+            return [], query.order_by(None).count() if start else 0
+        items = [row[0] for row in rows] if single else [tuple(row[:-1]) for row in rows]
+        return items, rows[0][-1]
+
+    @staticmethod
+    def __is_distinct(query: Query) -> bool:
+        # DISTINCT applies after window functions, so COUNT(*) OVER () would count the duplicates too
+        statement = query.statement
+        return bool(getattr(statement, "_distinct", False) or getattr(statement, "_distinct_on", ()))
+
+    @staticmethod
+    def __window_count_supported(query: Query) -> bool:
+        try:
+            dialect = query.session.get_bind().dialect
+        except Exception:
+            return False
+        minimum = WINDOW_FUNCTION_VERSIONS.get("mariadb" if getattr(dialect, "is_mariadb", False) else dialect.name)
+        if minimum is None: return False
+        version = dialect.server_version_info
+        return not minimum or (version is not None and tuple(version) >= minimum)
+
+    @staticmethod
+    def __count_key(query: Query):
+        bind = query.session.get_bind()
+        statement = query.order_by(None).limit(None).offset(None).statement
+        compiled = statement.compile(dialect=bind.dialect)
+        return str(bind.url), compiled.string, repr(sorted(compiled.params.items()))
+
+    def gen_page_data(self, start: int = None, count: int = None, cursor: str = None, cursor_key=None):
+        """Fills the paging fields from ``items`` fetched with ``count + 1`` rows.
+
+        Offset mode uses ``start``. Keyset mode is used when ``cursor_key`` (see
+        ``DatabaseModel.cursor_key``) is given: ``cursor`` is the one the items were fetched with, and
+        ``next_cursor``/``prev_cursor`` are generated from the first and last items.
+        """
+        if cursor_key is not None:
+            self.__gen_cursor_data(count, cursor, cursor_key)
+            return
+
         if start > 0:
             self.is_prev_page = True
             if start >= count:
@@ -31,7 +167,7 @@ class Page(JSONSerializable):
 
         if len(self.items) > count:
             self.is_next_page = True
-            if start + count <= self.total_count - count:
+            if self.total_count is None or start + count <= self.total_count - count:
                 self.next_page_start = start + count
                 self.next_page_count = count
             else:
@@ -42,6 +178,21 @@ class Page(JSONSerializable):
             self.is_next_page = False
         self.count = len(self.items)
 
+    def __gen_cursor_data(self, count: int, cursor: str, cursor_key):
+        backward = bool(cursor) and PageCursor.decode(cursor)[0] == PageCursor.PREV
+        is_more = len(self.items) > count
+        if is_more:
+            # Backward pages are fetched in reverse, so the extra row is the first one once reordered
+            self.items = self.items[1:] if backward else self.items[:-1]
+        self.count = len(self.items)
+
+        self.is_prev_page = bool(self.items) and (is_more if backward else bool(cursor))
+        self.is_next_page = bool(self.items) and (True if backward else is_more)
+        if self.is_prev_page:
+            self.prev_cursor = PageCursor.encode(PageCursor.PREV, cursor_key(self.items[0]))
+        if self.is_next_page:
+            self.next_cursor = PageCursor.encode(PageCursor.NEXT, cursor_key(self.items[-1]))
+
     # def gen_page_urls(self, baseurl: str, params: dict):
     #     clean_params = DictUtil.delete_null_values(params)
     #     params_str = ""
@@ -59,8 +210,11 @@ class Page(JSONSerializable):
     def to_json_dict(self, include: list = None):
         json_dict = super().to_json_dict(include)
         json_dict["count"] = self.count
-        json_dict["items"] = [item.to_json_dict(include) for item in self.items]
+        json_dict["items"] = to_json_list(self.items, include)
         json_dict["total_count"] = self.total_count
         json_dict["is_prev"] = self.is_prev_page
         json_dict["is_next"] = self.is_next_page
+        if self.next_cursor or self.prev_cursor:
+            json_dict["next_cursor"] = self.next_cursor
+            json_dict["prev_cursor"] = self.prev_cursor
         return json_dict
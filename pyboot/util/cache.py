@@ -0,0 +1,138 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheBackend(object):
+    """Interface for the caches used by pyboot; implement it to plug in a shared cache."""
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl: float = None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LRUCache(CacheBackend):
+    """Thread-safe in-process cache with LRU eviction, optional expiry and hit/miss counters.
+
+    With ``max_bytes``, entries are also evicted once their total ``size`` (given to ``set``, ``sizeof``
+    otherwise) goes over it.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = None, max_bytes: int = None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or sys.getsizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self.__entries[key]
+                self.bytes -= entry[2]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl: float = None, size: int = None):
+        if ttl is None: ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        if self.max_bytes is None:
+            size = 0
+        elif size is None:
+            size = self.sizeof(value)
+        with self.__lock:
+            previous = self.__entries.pop(key, None)
+            if previous is not None: self.bytes -= previous[2]
+            if self.max_bytes is not None and size > self.max_bytes: return
+            self.__entries[key] = (value, expires, size)
+            self.bytes += size
+            while len(self.__entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.bytes -= self.__entries.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None: self.bytes -= entry[2]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        stats = {"hits": self.hits, "misses": self.misses, "entries": len(self.__entries)}
+        if self.max_bytes is not None: stats["bytes"] = self.bytes
+        return stats
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key: the first runs, the others wait for and share its result
+    (or its exception). ``shared`` counts the calls that were suppressed."""
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self.__flights = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.__lock:
+            flight = self.__flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.__flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None: raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+            flight.done.set()
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self.__flights)}
@@ -62,6 +62,12 @@ class TimeUtil(object):
 class DatetimeUtil(object):
     default_tz = tzlocal.get_localzone()
 
+    @staticmethod
+    def localize(dt, timezone):
+        # pytz zones need localize(); zoneinfo zones (newer tzlocal) are attached directly
+        if hasattr(timezone, "localize"): return timezone.localize(dt)
+        return dt.replace(tzinfo=timezone)
+
     @staticmethod
     def iso_to_dt_utc(dt_str, microseconds=False, default=None):
         if dt_str is None: return default
@@ -93,7 +99,7 @@ class DatetimeUtil(object):
     def dt_to_iso(dt, default_tz=default_tz, microseconds=False, default=None):
         if dt is None: return default
         if dt.tzinfo is None:
-            dt = default_tz.localize(dt)
+            dt = DatetimeUtil.localize(dt, default_tz)
         dt = dt.astimezone(pytz.utc)
         if not microseconds:
             dt = dt.replace(microsecond=0)
@@ -103,21 +109,21 @@ class DatetimeUtil(object):
     def dt_to_dt_local(dt, default_tz=default_tz, default=None):
         if dt is None: return default
         if dt.tzinfo is None:
-            dt = default_tz.localize(dt)
+            dt = DatetimeUtil.localize(dt, default_tz)
         return dt.astimezone(tzlocal.get_localzone())
 
     @staticmethod
     def dt_to_dt_utc(dt, default_tz=default_tz, default=None):
         if dt is None: return default
         if dt.tzinfo is None:
-            dt = default_tz.localize(dt)
+            dt = DatetimeUtil.localize(dt, default_tz)
         return dt.astimezone(pytz.utc)
 
     @staticmethod
     def dt_to_dt_timezone(dt, timezone, default_tz=default_tz, default=None):
         if dt is None: return default
         if dt.tzinfo is None:
-            dt = default_tz.localize(dt)
+            dt = DatetimeUtil.localize(dt, default_tz)
         return dt.astimezone(timezone)
 
     @staticmethod
@@ -1,25 +1,37 @@
 import datetime
+import enum
 import json
+import uuid
+from itertools import islice
 
-from flask import Response
+from flask import Response, has_request_context, stream_with_context
+from sqlalchemy.orm import Query
 
 from pyboot.util.common import DatetimeUtil, DateUtil, TimeUtil
 from pyboot.common.conf import MIME_TYPE_JSON
-from pyboot.json import JSONSerializable
-from pyboot.model import ModelBase
+from pyboot.json import JSONSerializable, to_json_list
 
+STREAM_CHUNK_SIZE = 500
+
+
+def json_response(obj, include=None, status=200, mimetype=MIME_TYPE_JSON, stream=False,
+                  chunk_size=STREAM_CHUNK_SIZE):
+    """Builds a JSON response.
+
+    With ``stream=True``, ``obj`` is a list, iterable or SQLAlchemy ``Query`` and the JSON array is
+    written ``chunk_size`` items at a time while rows are fetched. Inside a request, the request and app
+    contexts (and the scoped ``Db`` session) stay alive until the body has been sent; otherwise the session
+    behind a streamed query must stay open until then.
+    """
+    if stream:
+        body = stream_json(obj, include, chunk_size)
+        if has_request_context(): body = stream_with_context(body)
+        return Response(response=body, mimetype=mimetype, status=status)
 
-def json_response(obj, include=None, status=200, mimetype=MIME_TYPE_JSON):
     if isinstance(obj, str):
         response = obj
     elif isinstance(obj, list):
-        final_obj = []
-        for o in obj:
-            if isinstance(o, JSONSerializable):
-                final_obj.append(o.to_json_dict(include))
-            else:
-                final_obj.append(o)
-        response = dump_json(final_obj)
+        response = dump_json(to_json_list(obj, include))
     elif isinstance(obj, JSONSerializable):
         response = dump_json(obj.to_json_dict(include))
     else:
@@ -27,26 +39,74 @@ def json_response(obj, include=None, status=200, mimetype=MIME_TYPE_JSON):
     return Response(response=response, mimetype=mimetype, status=status)
 
 
+def stream_json(items, include=None, chunk_size=STREAM_CHUNK_SIZE):
+    if isinstance(items, Query): items = items.yield_per(chunk_size)
+    items = iter(items)
+
+    # Chunks are joined the way json.dumps joins items, so the output matches the non-streamed body
+    prefix = "["
+    for chunk in iter(lambda: list(islice(items, chunk_size)), []):
+        yield prefix + dump_json(to_json_list(chunk, include))[1:-1]
+        prefix = ", "
+    yield "]" if prefix == ", " else "[]"
+
+
+_encoders = {
+    bytes: lambda obj: obj.decode("utf-8"),
+    datetime.datetime: DatetimeUtil.dt_to_iso,
+    datetime.date: DateUtil.date_to_iso,
+    datetime.time: TimeUtil.time_to_iso,
+    JSONSerializable: lambda obj: obj.to_json_dict(),
+    uuid.UUID: str,
+    enum.Enum: lambda obj: obj.value,
+    set: list,
+    frozenset: list,
+}
+_encoder_cache = {}
+
+_dumps = json.dumps
+_loads = json.loads
+
+
+def register_encoder(type: type, encoder):
+    """Registers ``encoder(obj)`` for ``type`` and its subclasses, e.g. ``register_encoder(Decimal, str)``."""
+    _encoders[type] = encoder
+    _encoder_cache.clear()
+
+
+def set_json_backend(dumps=None, loads=None):
+    """Replaces the stdlib ``json`` functions used by ``dump_json``/``load_json``; ``None`` restores them.
+
+    ``dumps(obj, default=...)`` must call ``default`` for every value it can't encode natively. For orjson,
+    pass ``OPT_PASSTHROUGH_DATETIME`` so datetimes keep going through the registered encoders.
+    """
+    global _dumps, _loads
+    _dumps = dumps or json.dumps
+    _loads = loads or json.loads
+
+
+def _find_encoder(cls):
+    for base in cls.__mro__:
+        if base in _encoders: return _encoders[base]
+    if hasattr(cls, "__iter__"): return list
+    return None
+
+
 def __serialize_object(obj):
-    if isinstance(obj, bytes):
-        return obj.decode("utf-8")
-    elif isinstance(obj, datetime.datetime):
-        return DatetimeUtil.dt_to_iso(obj)
-    elif isinstance(obj, datetime.date):
-        return DateUtil.date_to_iso(obj)
-    elif isinstance(obj, datetime.time):
-        return TimeUtil.time_to_iso(obj)
-    elif issubclass(obj.__class__, ModelBase):
-        return obj.to_json_dict()
-    elif issubclass(obj.__class__, JSONSerializable):
-        return obj.to_json_dict()
-    else:
-        return iter(obj)
+    cls = obj.__class__
+    try:
+        encoder = _encoder_cache[cls]
+    except KeyError:
+        encoder = _encoder_cache[cls] = _find_encoder(cls)
+    if encoder is None:
+        raise TypeError("Object of type %s is not JSON serializable" % cls.__name__)
+    return encoder(obj)
 
 
 def dump_json(obj):
-    return json.dumps(obj, default=__serialize_object)
+    value = _dumps(obj, default=__serialize_object)
+    return value.decode("utf-8") if isinstance(value, bytes) else value
 
 
 def load_json(obj):
-    return json.loads(obj)
+    return _loads(obj)
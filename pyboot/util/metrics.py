@@ -0,0 +1,84 @@
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram of durations in seconds, cheap enough to update on every event."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float):
+        with self.__lock:
+            counts = list(self.counts)
+        return quantile(self.buckets, counts, q)
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        cumulative = 0
+        buckets = []
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            buckets.append((bound, cumulative))
+        return {"count": count, "sum": total, "buckets": buckets}
+
+
+def quantile(buckets: tuple, counts: list, q: float):
+    """Estimates the ``q`` quantile from bucket ``counts`` (one more than ``buckets``, for +Inf), interpolating
+    linearly inside the bucket; ``None`` when empty. Values past the last bound read as that bound."""
+    total = sum(counts)
+    if not total: return None
+    rank = q * total
+    cumulative = 0
+    for index, count in enumerate(counts):
+        if count and cumulative + count >= rank:
+            if index == len(buckets): return buckets[-1]
+            lower = buckets[index - 1] if index else 0.0
+            return lower + (buckets[index] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+def _labels(labels: dict) -> str:
+    if not labels: return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+def _bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def prometheus_lines(name: str, kind: str, samples: list, doc: str = None) -> list:
+    """Renders ``(labels, value)`` samples of one metric in the Prometheus text format.
+
+    For histograms the value is a ``Histogram.snapshot()``.
+    """
+    lines = []
+    if doc: lines.append("# HELP %s %s" % (name, doc))
+    lines.append("# TYPE %s %s" % (name, kind))
+    for labels, value in samples:
+        if kind != "histogram":
+            lines.append("%s%s %s" % (name, _labels(labels), value))
+            continue
+        for bound, count in value["buckets"]:
+            bucket_labels = dict(labels, le=_bound(bound))
+            lines.append("%s_bucket%s %s" % (name, _labels(bucket_labels), count))
+        lines.append("%s_sum%s %s" % (name, _labels(labels), value["sum"]))
+        lines.append("%s_count%s %s" % (name, _labels(labels), value["count"]))
+    return lines
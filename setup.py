@@ -75,19 +75,22 @@ setup(
         'pytz>=2015.2',
         'iso8601>=0.1.10',
         'PyYAML>=3.11',
-        'SQLAlchemy>=1.0.9',
+        'SQLAlchemy>=2.0',
         'mysqlclient>=1.3.7',
         'tzlocal>=1.1.3',
-        'Flask>=0.10.1',
+        'Flask>=2.2',
         'pycrypto>=2.6.1',
-        'requests>=2.9.1'
+        'requests>=2.26'
     ],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
     # for example:
     # $ pip install -e .[dev,test]
-    extras_require={},
+    extras_require={
+        'async': ['greenlet>=1', 'aiomysql>=0.1'],
+        'test': ['pytest>=7', 'greenlet>=1', 'aiosqlite>=0.17'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
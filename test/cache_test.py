@@ -0,0 +1,172 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import Column
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Integer
+from sqlalchemy import String
+
+from model_test import count_statements
+from pyboot.model import DatabaseModelBase
+from pyboot.util.cache import LRUCache, SingleFlight
+
+
+class Country(DatabaseModelBase):
+    __tablename__ = "countries"
+    __cache__ = {"ttl": 60, "max_entries": 100}
+
+    name = Column(String)
+    population = Column(Integer)
+
+
+class City(DatabaseModelBase):
+    __tablename__ = "cities"
+    __cache__ = {"ttl": 60, "single_flight": True}
+
+    name = Column(String)
+
+
+def add_countries(db, count):
+    Country.bulk_insert(db, [{"id": i + 1, "name": "country %s" % i, "population": i} for i in range(count)])
+    db.commit()
+
+
+def test_lru_cache():
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert (cache.get("b"), cache.get("a"), cache.get("c")) == (None, 1, 3)
+
+    cache.set("d", 4, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get("d", "expired") == "expired"
+    assert cache.stats() == {"hits": 3, "misses": 2, "entries": 1}
+
+
+def test_lru_cache_max_bytes():
+    cache = LRUCache(max_bytes=10)
+    cache.set("a", "a", size=4)
+    cache.set("b", "b", size=4)
+    cache.set("a", "a", size=5)
+    assert (cache.bytes, len(cache)) == (9, 2)
+    cache.set("c", "c", size=3)
+    assert (cache.get("b"), cache.get("a"), cache.get("c")) == (None, "a", "c")
+    cache.set("big", "big", size=11)
+    assert (cache.get("big"), cache.bytes) == (None, 8)
+    cache.delete("a")
+    assert cache.stats() == {"hits": 2, "misses": 2, "entries": 1, "bytes": 3}
+
+
+def run_concurrently(count, fn):
+    results = [None] * count
+    threads = [threading.Thread(target=lambda index=index: results.__setitem__(index, fn())) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return len(calls)
+
+    waiter = threading.Thread(target=lambda: (wait_until(lambda: flight.stats()["shared"] == 4), release.set()))
+    waiter.start()
+    assert run_concurrently(5, lambda: flight.do("key", slow)) == [1] * 5
+    assert flight.stats() == {"calls": 1, "shared": 4, "in_flight": 0}
+
+    with pytest.raises(ZeroDivisionError):
+        flight.do("key", lambda: 1 / 0)
+    assert flight.do("key", lambda: "again") == "again"
+
+
+def wait_until(condition, timeout=5):
+    expires = time.monotonic() + timeout
+    while not condition() and time.monotonic() < expires:
+        time.sleep(0.001)
+
+
+def test_get_is_cached_and_invalidated(db, engine):
+    add_countries(db, 3)
+    assert Country.get(db, 2).name == "country 1"
+    db.expunge_all()
+
+    country = []
+    assert count_statements(engine, lambda: country.append(Country.get(db, 2))) == 0
+    assert country[0].name == "country 1" and country[0] in db
+    assert Country.get(db, 2) is country[0]
+
+    country[0].name = "renamed"
+    db.commit()
+    db.expunge_all()
+    assert Country.get(db, 2).name == "renamed"
+
+    Country.delete(db, 2)
+    db.commit()
+    db.expunge_all()
+    assert Country.get(db, 2) is None
+
+
+def test_get_all_is_cached_and_invalidated(db, engine):
+    add_countries(db, 5)
+    names = [country.name for country in Country.get_all(db, count=3, order_by=Country.population.desc())]
+    db.expunge_all()
+    items = []
+    assert count_statements(engine, lambda: items.extend(
+        Country.get_all(db, count=3, order_by=Country.population.desc()))) == 0
+    assert [country.name for country in items] == names
+
+    db.add(Country(id=9, name="new", population=100))
+    db.commit()
+    assert Country.get_all(db, count=3, order_by=Country.population.desc())[0].name == "new"
+
+    Country.bulk_insert(db, [{"id": 10, "name": "bulk", "population": 200}])
+    db.commit()
+    assert Country.get_all(db, count=3, order_by=Country.population.desc())[0].name == "bulk"
+    assert Country.cache_stats()["hits"] >= 1
+
+
+def test_uncommitted_rows_are_not_cached(db):
+    add_countries(db, 2)
+    country = Country.get(db, 1)
+    country.name = "dirty"
+    db.rollback()
+    db.expunge_all()
+    assert Country.get(db, 1).name == "country 0"
+
+
+def test_get_single_flight(tmp_path):
+    engine = create_engine("sqlite:///%s" % (tmp_path / "cities.db"))
+    DatabaseModelBase.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    City.bulk_insert(db, [{"id": 1, "name": "first"}, {"id": 2, "name": "second"}])
+    db.commit()
+    flight = City._get_cache().flight
+    listener = lambda *args: wait_until(lambda: flight.stats()["shared"] >= 3)
+    event.listen(engine, "before_cursor_execute", listener)
+    all_sessions = [db] + [sessionmaker(bind=engine)() for _ in range(3)]
+    sessions = list(all_sessions)
+    try:
+        # One thread per session; the first one runs the query while the others wait for it
+        cities = run_concurrently(4, lambda: City.get(sessions.pop(0), 2))
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+        for session in all_sessions:
+            session.close()
+        engine.dispose()
+    assert [city.name for city in cities] == ["second"] * 4
+    assert len({id(city) for city in cities}) == 4
+    assert flight.stats() == {"calls": 1, "shared": 3, "in_flight": 0}
+    assert City.cache_stats()["single_flight"]["calls"] == 1
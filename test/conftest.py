@@ -0,0 +1,79 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from model_test import DatabaseModelBase
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    DatabaseModelBase.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    db = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)()
+    yield db
+    db.close()
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+    """``/status/<code>`` answers with that code, ``/sleep/<seconds>`` answers after a delay and
+    ``/etag/<max-age>`` serves ``server.version`` with an ETag and ``Cache-Control: max-age``. ``/script``
+    answers with the next ``(status, delay)`` of ``server.script``, 200 at once when it is empty, and
+    ``/cookie/<value>`` sets a ``session`` cookie. Request ``Cookie`` headers go to ``server.cookies``."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.requests.append((self.command, self.path, self.client_address[1]))
+        self.server.cookies.append(self.headers.get("Cookie"))
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[0] == "sleep": time.sleep(float(parts[1]))
+        status = int(parts[1]) if parts[0] == "status" else 200
+        if parts[0] == "script":
+            with self.server.lock:
+                status, delay = self.server.script.pop(0) if self.server.script else (200, 0)
+            time.sleep(delay)
+        body = ('{"path": "%s", "version": %s}' % (self.path, self.server.version)).encode()
+        etag = '"v%s"' % self.server.version
+        if parts[0] == "etag" and self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        self.send_response(status)
+        if parts[0] == "cookie": self.send_header("Set-Cookie", "session=%s; Path=/" % parts[1])
+        if parts[0] == "etag":
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "max-age=%s" % parts[1])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HttpHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.cookies = []
+    server.version = 1
+    server.script = []
+    server.lock = threading.Lock()
+    server.url = "http://127.0.0.1:%s" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,506 @@
+import array
+import asyncio
+import json
+import os
+from contextlib import contextmanager
+
+import pytest
+from flask import Flask
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from cache_test import Country
+from model_test import DatabaseModelBase, Person
+from pyboot.common import database
+from pyboot.common.conf import Conf
+from pyboot.common.database import AsyncDb, Db, QueryTracer, DBQueryHandler, FORMAT_TUPLE, FORMAT_NAMED, FORMAT_COLUMNAR, \
+    LEAST_OUTSTANDING, PRIMARY, SHARD_LOOKUP, SHARD_RANGE, ShardRouter, _statement, prometheus_metrics
+from pyboot.common.decorator import Controller
+from pyboot.common.exception import InvalidValueException, InvalidStateException
+from pyboot.util.json import json_response
+from pyboot.util.metrics import Histogram
+
+
+def add_persons(db, count):
+    Person.bulk_insert(db, [{"id": i + 1, "name": "person %s" % i, "age": i} for i in range(count)])
+    db.commit()
+
+
+def test_get(db):
+    add_persons(db, 3)
+    assert DBQueryHandler.get(db, "select id, name from persons order by id") == [
+        {"id": 1, "name": "person 0"}, {"id": 2, "name": "person 1"}, {"id": 3, "name": "person 2"}]
+    assert DBQueryHandler.get(db, "select id from persons where id = 2", one=True) == {"id": 2}
+    assert DBQueryHandler.get_all(db, "select age from persons order by id") == [0, 1, 2]
+
+
+def test_stream(db):
+    add_persons(db, 25)
+    query = "select id, name, age from persons order by id"
+    expected = DBQueryHandler.get(db, query)
+
+    batches = list(DBQueryHandler.stream_batches(db, query, batch_size=10))
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert [row for batch in batches for row in batch] == expected
+    assert list(DBQueryHandler.stream(db, query, batch_size=7)) == expected
+
+    rows = DBQueryHandler.stream(db, query, batch_size=7)
+    assert next(rows) == expected[0]
+    rows.close()
+    assert DBQueryHandler.get_all(db, "select count(*) from persons", one=True) == 25
+
+
+def test_formats(db, monkeypatch):
+    monkeypatch.setattr(database, "numpy", None)
+    add_persons(db, 3)
+    query = "select id, name, age * 1.5 as score from persons order by id"
+    assert DBQueryHandler.get(db, query, format=FORMAT_TUPLE)[0] == (1, "person 0", 0.0)
+
+    row = DBQueryHandler.get(db, query, one=True, format=FORMAT_NAMED)
+    assert (row.id, row.name, row.score) == (1, "person 0", 0.0)
+
+    columns = DBQueryHandler.get(db, query, format=FORMAT_COLUMNAR)
+    assert columns["id"] == array.array("q", [1, 2, 3])
+    assert columns["score"] == array.array("d", [0.0, 1.5, 3.0])
+    assert columns["name"] == ["person 0", "person 1", "person 2"]
+    assert DBQueryHandler.get(db, query + " limit 0", format=FORMAT_COLUMNAR) == {"id": [], "name": [], "score": []}
+
+    batches = list(DBQueryHandler.stream_batches(db, query, batch_size=2, format=FORMAT_COLUMNAR))
+    assert [list(batch["id"]) for batch in batches] == [[1, 2], [3]]
+    with pytest.raises(InvalidValueException):
+        list(DBQueryHandler.stream(db, query, format=FORMAT_COLUMNAR))
+
+
+def test_bind_parameters(db):
+    add_persons(db, 5)
+    query = "select id, name from persons where age >= :age order by id"
+    assert DBQueryHandler.get(db, query, params={"age": 3}) == [{"id": 4, "name": "person 3"},
+                                                                 {"id": 5, "name": "person 4"}]
+    assert DBQueryHandler.get(db, query, params={"age": "0 or 1=1"}) == []
+    assert _statement(query) is _statement(query)
+    assert list(DBQueryHandler.stream(db, query, params={"age": 4})) == [{"id": 5, "name": "person 4"}]
+
+    assert DBQueryHandler.update(db, "update persons set name = :name where id = :id",
+                                 params={"name": "updated", "id": 1}) == 1
+    assert DBQueryHandler.update_many(db, "update persons set age = :age where id = :id",
+                                      [{"age": 10, "id": 1}, {"age": 20, "id": 2}]) == 2
+    assert DBQueryHandler.get_all(db, "select age from persons where id < :id order by id", params={"id": 4}) == \
+        [10, 20, 2]
+    assert DBQueryHandler.get(db, "select name from persons where id = :id", one=True, params={"id": 1}) == \
+        {"name": "updated"}
+
+
+@pytest.fixture
+def replicas(tmp_path):
+    def init(**db_conf):
+        conf = {"url": "sqlite:///%s" % (tmp_path / "primary.db"), "init_pool_size": 2, "max_pool_size": 4,
+                "pool_recycle_delay": 3600, "sql_logging": False, "replica_sticky_seconds": 0,
+                "replicas": [{"url": "sqlite:///%s" % (tmp_path / "replica1.db")},
+                             {"name": "reports", "url": "sqlite:///%s" % (tmp_path / "replica2.db")}]}
+        conf.update(db_conf)
+        Conf.get_instance().app_conf = {"database": conf}
+        Db.get_instance().init()
+        for name in [PRIMARY] + Db.router().names + (Db.shards().names if Db.shards() else []):
+            DatabaseModelBase.metadata.create_all(Db.engine(name))
+            with Db.engine(name).begin() as connection:
+                connection.exec_driver_sql("delete from persons")
+                connection.exec_driver_sql("insert into persons (id, name) values (1, '%s')" % name)
+        return Db
+
+    yield init
+    Db.get_instance().dispose()
+    Conf.get_instance().app_conf = None
+
+
+def read_name(readonly=True):
+    with Db.get(readonly=readonly) as db:
+        return DBQueryHandler.get_all(db, "select name from persons", one=True)
+
+
+def test_replica_round_robin(replicas):
+    replicas()
+    assert [read_name() for _ in range(4)] == ["replica1", "reports", "replica1", "reports"]
+    assert read_name(readonly=False) == PRIMARY
+
+    with Db.get(readonly=True) as db:
+        db.add(Person(id=2))
+        with pytest.raises(InvalidStateException):
+            db.flush()
+
+
+def test_replica_least_outstanding(replicas):
+    replicas(replica_policy=LEAST_OUTSTANDING)
+    with Db.get(readonly=True) as db:
+        assert DBQueryHandler.get_all(db, "select name from persons", one=True) == "replica1"
+        assert read_name() == "reports"
+    assert read_name() == "replica1"
+
+
+def test_replica_lag_fallback(replicas):
+    replicas(max_replica_lag=10, replica_lag_check_interval=60)
+    lags = {"replica1": 30, "reports": 2}
+    checks = []
+
+    def lag_check(engine):
+        name = "replica1" if engine is Db.engine("replica1") else "reports"
+        checks.append(name)
+        return lags[name]
+
+    Db.router().lag_check = lag_check
+    assert [read_name() for _ in range(3)] == ["reports"] * 3
+    assert sorted(checks) == ["replica1", "reports"]
+
+    lags["reports"] = None
+    Db.router().lag_check_interval = 0
+    assert read_name() == PRIMARY
+
+
+class StatusEngine(object):
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.statements = []
+
+    @contextmanager
+    def connect(self):
+        yield self
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+        status = self.statuses.get(str(statement))
+        if status is None: raise ProgrammingError(str(statement), {}, Exception("syntax error"))
+        return StatusResult(status)
+
+
+class StatusResult(object):
+    def __init__(self, status):
+        self.status = status
+
+    def keys(self):
+        return list(self.status)
+
+    def first(self):
+        return tuple(self.status.values()) or None
+
+
+def test_mysql_replica_lag():
+    engine = StatusEngine({"SHOW REPLICA STATUS": {"Replica_IO_Running": "Yes", "Seconds_Behind_Source": 3}})
+    assert database.mysql_replica_lag(engine) == 3
+    engine = StatusEngine({"SHOW SLAVE STATUS": {"Seconds_Behind_Master": 7}})
+    assert database.mysql_replica_lag(engine) == 7
+    assert engine.statements == ["SHOW REPLICA STATUS", "SHOW SLAVE STATUS"]
+    assert database.mysql_replica_lag(StatusEngine({"SHOW REPLICA STATUS": {}})) is None
+
+
+def test_replica_sticky_after_write(replicas):
+    replicas(replica_sticky_seconds=60)
+    with Db.get() as db:
+        db.add(Person(id=2, name="new"))
+        db.commit()
+    assert read_name() == PRIMARY
+
+    replicas()
+    with Flask(__name__).app_context():
+        assert read_name() == "replica1"
+        with Db.get() as db:
+            db.commit()
+        assert read_name() == PRIMARY
+    with Flask(__name__).app_context():
+        assert read_name() == "reports"
+    with Flask(__name__).app_context():
+        with Db.get() as db:
+            db.add(Person(id=3, name="flushed"))
+            db.flush()
+            assert read_name() == PRIMARY
+            db.rollback()
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.01, 0.1))
+    for value in (0.005, 0.01, 0.05, 3):
+        histogram.observe(value)
+    assert histogram.snapshot() == {"count": 4, "sum": 3.065, "buckets": [(0.01, 2), (0.1, 3), (float("inf"), 4)]}
+
+
+def test_pool_stats(replicas):
+    replicas(replicas=[])
+    assert read_name(readonly=False) == PRIMARY
+    with Db.get() as db:
+        assert DBQueryHandler.get_all(db, "select count(*) from persons", one=True) == 1
+        stats = Db.stats()[PRIMARY]
+        assert (stats["checked_out"], stats["pool_size"]) == (1, 2)
+
+    stats = Db.stats()[PRIMARY]
+    assert (stats["checked_out"], stats["checkouts"], stats["connections_created"]) == (0, 4, 1)
+    assert stats["checkout_wait"]["count"] == 4
+    assert stats["statements"]["select"]["count"] == 2
+    assert stats["statements"]["insert"]["count"] == 1
+
+    with Db.engine().connect() as connection:
+        connection.invalidate()
+    read_name(readonly=False)
+    assert Db.stats()[PRIMARY]["connections_recycled"] == 1
+
+    with pytest.raises(OperationalError):
+        with Db.get() as db:
+            DBQueryHandler.get(db, "select * from missing")
+    with Db.engine().connect() as connection:
+        assert not [key for key in connection.info if key.startswith("pyboot")]
+
+    text = prometheus_metrics()
+    assert 'pyboot_db_checked_out{db="primary"} 0' in text
+    assert 'pyboot_db_statement_seconds_count{db="primary",statement="select"} 3' in text
+    assert 'pyboot_db_checkout_wait_seconds_bucket{db="primary",le="+Inf"} 8' in text
+
+
+def test_query_tracer(replicas, caplog):
+    replicas(replicas=[], query_budget=2)
+    app = Flask(__name__)
+
+    @app.route("/names/<int:count>")
+    @Controller.get_instance().api_controller()
+    def names(count):
+        return "".join(read_name(readonly=False) for _ in range(count))
+
+    client = app.test_client()
+    response = client.get("/names/2")
+    assert response.data == b"primaryprimary"
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+    assert response.headers["Server-Timing"].endswith(';desc="2 queries, 0 rows"')
+    assert "Slow request" not in caplog.text
+
+    assert client.get("/names/3").status_code == 200
+    assert "Slow request [GET /names/3]: 3 queries" in caplog.text
+    assert "select name from persons" in caplog.text
+
+    Conf.get("database")["query_budget_strict"] = True
+    assert client.get("/names/3").status_code == 500
+    assert "exceeded its budget of 2 queries" in caplog.text
+    with Db.engine().connect() as connection:
+        assert not [key for key in connection.info if key.startswith("pyboot")]
+
+    Conf.get("database")["query_trace"] = False
+    assert "Server-Timing" not in client.get("/names/3").headers
+
+
+def test_async_db(replicas):
+    replicas(replicas=[])
+    with Db.get() as db:
+        Person.bulk_insert(db, [{"id": i, "name": "person %s" % i} for i in range(2, 6)])
+        db.commit()
+    assert AsyncDb.url({"url": "mysql://db/app?charset=utf8"}).drivername == "mysql+aiomysql"
+    assert AsyncDb.url({"host": "db", "name": "app", "charset": "utf8", "user": "app", "password": "secret"}
+                       ).render_as_string(False) == "mysql+aiomysql://app:secret@db/app?charset=utf8"
+
+    async def run():
+        AsyncDb.get_instance().init()
+        try:
+            async with AsyncDb.get() as db1, AsyncDb.get() as db2, AsyncDb.get() as db3:
+                person, persons, many = await asyncio.gather(
+                    Person.get_async(db1, 3), Person.get_all_async(db2, count=2, order_by=Person.id.desc()),
+                    Person.get_many_async(db3, [5, 42, 1], keep_missing=True))
+            assert person.name == "person 3"
+            assert [person.id for person in persons] == [5, 4]
+            assert [person.id if person else None for person in many] == [5, None, 1]
+
+            with pytest.raises(ZeroDivisionError):
+                async with AsyncDb.get() as db:
+                    db.add(Person(id=6, name="rolled back"))
+                    await db.flush()
+                    1 / 0
+            async with AsyncDb.get() as db:
+                assert await Person.get_async(db, 6) is None
+        finally:
+            await AsyncDb.get_instance().dispose()
+
+    asyncio.run(run())
+
+
+def test_request_scoped_sessions(replicas, monkeypatch):
+    replicas(replicas=[])
+    monkeypatch.setattr(Db, "_Db__scoped", None)
+    app = Flask(__name__)
+    Db.get_instance().init_app(app)
+    sessions = []
+
+    @app.route("/persons/<int:id>", methods=["POST"])
+    def add_person(id):
+        with Db.get() as db:
+            sessions.append(db)
+            db.add(Person(id=id, name="person %s" % id))
+            db.flush()
+            with Db.get(readonly=True) as nested:
+                sessions.append(nested)
+                assert nested.get(Person, id).name == "person %s" % id
+        with Db.get() as db:
+            sessions.append(db)
+            if id > 10: raise InvalidValueException("too big")
+        return "ok"
+
+    @app.route("/api/persons/<int:id>", methods=["POST"])
+    @Controller.get_instance().api_controller()
+    def add_person_api(id):
+        with Db.get() as db:
+            db.add(Person(id=id, name="person %s" % id))
+            db.flush()
+            with Db.get(readonly=True) as nested:
+                assert nested.get(Person, id) is not None
+        raise InvalidValueException("rejected")
+
+    client = app.test_client()
+    checkouts = Db.stats()[PRIMARY]["checkouts"]
+    assert client.post("/persons/2").data == b"ok"
+    assert sessions[0] is sessions[1] is sessions[2]
+    assert Db.stats()[PRIMARY]["checkouts"] == checkouts + 1
+    assert client.post("/persons/3").status_code == 200
+    assert sessions[3] is not sessions[0]
+
+    app.testing = False
+    assert client.post("/persons/11").status_code == 500
+    assert client.post("/api/persons/4").status_code == 400
+    assert Db.stats()[PRIMARY]["checked_out"] == 0
+    with Db.get() as db:
+        assert [person.id for person in Person.get_all(db, order_by=Person.id)] == [1, 2, 3]
+
+
+def test_other_apps_are_not_scoped(replicas, monkeypatch):
+    replicas(replicas=[], init_pool_size=1, max_pool_size=2)
+    monkeypatch.setattr(Db, "_Db__scoped", None)
+    Db.get_instance().init_app(Flask(__name__))
+    for _ in range(3):
+        with Flask("admin").app_context():
+            with Db.get() as db:
+                db.add(Person(id=db.query(Person).count() + 1, name="admin"))
+                db.commit()
+            with Db.get() as other:
+                assert other is not db
+    assert Db.stats()[PRIMARY]["checked_out"] == 0
+    with Db.get() as db:
+        assert db.query(Person).count() == 4
+
+
+def test_pool_warmup(replicas):
+    replicas(replicas=[], pool_pre_ping=True)
+    assert Db.get_instance().warmup() == 2
+    stats = Db.stats()[PRIMARY]
+    assert (stats["connections_created"], stats["checked_in"], stats["checked_out"]) == (2, 2, 0)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_fork_drops_inherited_pool(replicas):
+    replicas(replicas=[])
+    assert read_name(readonly=False) == PRIMARY
+    parent_connections = Db.stats()[PRIMARY]["connections_created"]
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            opened = Db.stats()[PRIMARY]["connections_created"]
+            Db.get_instance().warmup()
+            stats = Db.stats()[PRIMARY]
+            result = "%s %s %s %s" % (opened, stats["connections_created"], stats["checked_in"],
+                                      read_name(readonly=False))
+        except BaseException as e:
+            result = repr(e)
+        os.write(write_fd, result.encode())
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as child:
+        assert child.read() == "0 2 2 primary"
+    os.waitpid(pid, 0)
+    assert Db.stats()[PRIMARY]["connections_created"] == parent_connections
+    assert read_name(readonly=False) == PRIMARY
+
+
+def test_shard_router():
+    router = ShardRouter(["a", "b", "c"])
+    assert [router.shard_for(key) for key in (0, 1, 5, "42")] == ["a", "b", "c", router.shard_for("42")]
+    router = ShardRouter(["a", "b"], SHARD_RANGE, ranges={"a": (None, 10), "b": [10, 20]})
+    assert [router.shard_for(key) for key in (-5, 9, 10)] == ["a", "a", "b"]
+    with pytest.raises(InvalidValueException):
+        router.shard_for(20)
+    router = ShardRouter(["a", "b"], SHARD_LOOKUP, lookup={"7": "b"}, default="a")
+    assert [router.shard_for(7), router.shard_for(8)] == ["b", "a"]
+    assert ShardRouter(["a", "b"], lambda key: "b").shard_for(1) == "b"
+
+
+def test_sharded_get_all(replicas, tmp_path):
+    shards = [{"name": "low", "url": "sqlite:///%s" % (tmp_path / "low.db"), "key_range": [None, 100]},
+              {"name": "high", "url": "sqlite:///%s" % (tmp_path / "high.db"), "key_range": [100, None]}]
+    replicas(replicas=[], shards=shards, shard_function=SHARD_RANGE)
+    for tenant in (1, 150):
+        with Db.get(shard_key=tenant) as db:
+            db.query(Person).delete()
+            Person.bulk_insert(db, [{"id": tenant * 1000 + i, "name": "tenant %s" % tenant,
+                                     "age": (i * 7 + tenant) % 10} for i in range(6)])
+            db.commit()
+    with Db.get(shard_key=42) as db:
+        assert {person.name for person in Person.get_all(db)} == {"tenant 1"}
+    with Db.get(shard_key=999) as db:
+        assert {person.name for person in Person.get_all(db)} == {"tenant 150"}
+    with Db.get() as db:
+        assert [person.name for person in Person.get_all(db)] == [PRIMARY]
+
+    with Db.get(shard_key=1) as low, Db.get(shard_key=150) as high:
+        expected = sorted(Person.get_all(low) + Person.get_all(high), key=lambda person: (person.age, person.id),
+                          reverse=True)
+
+    with Db.shard_sessions() as dbs:
+        assert list(dbs) == ["low", "high"]
+        persons = Person.get_all_sharded(list(dbs.values()), start=3, count=5, order_by=Person.age.desc(),
+                                         executor=Db.executor())
+        assert [person.id for person in persons] == [person.id for person in expected[3:8]]
+        persons = Person.get_all_sharded(list(dbs.values()))
+        assert [person.id for person in persons] == [1000 + i for i in range(6)] + [150000 + i for i in range(6)]
+
+    for tenant in (1, 150):
+        with Db.get(shard_key=tenant) as db:
+            db.add(Person(id=tenant * 1000 + 99, name="no age"))
+            db.commit()
+    with Db.shard_sessions() as dbs:
+        persons = Person.get_all_sharded(list(dbs.values()), order_by=Person.age)
+        assert [person.id for person in persons][:2] == [1099, 150099]
+
+
+def test_sharded_model_cache(replicas, tmp_path):
+    shards = [{"name": "low", "url": "sqlite:///%s" % (tmp_path / "low.db"), "key_range": [None, 100]},
+              {"name": "high", "url": "sqlite:///%s" % (tmp_path / "high.db"), "key_range": [100, None]}]
+    replicas(replicas=[], shards=shards, shard_function=SHARD_RANGE)
+    for tenant in (1, 150):
+        with Db.get(shard_key=tenant) as db:
+            db.query(Country).delete()
+            db.add(Country(id=1, name="tenant %s" % tenant))
+            db.commit()
+
+    for _ in range(2):
+        for tenant in (1, 150):
+            with Db.get(shard_key=tenant) as db:
+                assert Country.get(db, 1).name == "tenant %s" % tenant
+                assert [country.name for country in Country.get_all(db)] == ["tenant %s" % tenant]
+    with Db.get(shard_key=1) as db:
+        Country.get(db, 1).name = "renamed"
+        db.commit()
+    with Db.get(shard_key=1) as low, Db.get(shard_key=150) as high:
+        assert (Country.get(low, 1).name, Country.get(high, 1).name) == ("renamed", "tenant 150")
+
+
+def test_streamed_response_keeps_scoped_session(replicas, monkeypatch):
+    replicas(replicas=[])
+    monkeypatch.setattr(Db, "_Db__scoped", None)
+    app = Flask(__name__)
+    Db.get_instance().init_app(app)
+    tracers = []
+
+    @app.route("/persons")
+    @Controller.get_instance().api_controller()
+    def persons():
+        tracers.append(QueryTracer.current())
+        with Db.get() as db:
+            return json_response(db.query(Person).order_by(Person.id), stream=True, chunk_size=1)
+
+    with Db.get() as db:
+        Person.bulk_insert(db, [{"id": i, "name": "person %s" % i} for i in range(2, 4)])
+        db.commit()
+    assert [person["name"] for person in json.loads(app.test_client().get("/persons").data)] == [
+        PRIMARY, "person 2", "person 3"]
+    assert tracers[0].statements == 1
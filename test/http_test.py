@@ -0,0 +1,210 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from pyboot.client.http import HttpClient, HttpResponseCache, RetryBudget
+from pyboot.util.cache import SingleFlight
+from pyboot.common.conf import Conf
+from pyboot.common.exception import DeadlineExceededException
+
+
+@pytest.fixture
+def client():
+    Conf.get_instance().app_conf = {"api_timeout": 5, "http_pool_maxsize": 4}
+    client = HttpClient()
+    yield client
+    client.close()
+    Conf.get_instance().app_conf = None
+
+
+def test_connections_are_reused(client, http_server):
+    for path in ("/a", "/b", "/c"):
+        assert client.get(url=http_server.url + path).json()["path"] == path
+    client.post(url=http_server.url + "/d", json={})
+    assert len({port for _, _, port in http_server.requests}) == 1
+
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(client.get(url=http_server.url) and client.session()))
+    thread.start()
+    thread.join()
+    assert sessions[0] is client.session()
+    assert len({port for _, _, port in http_server.requests}) == 1
+
+    client.close()
+    client.get(url=http_server.url)
+    assert len({port for _, _, port in http_server.requests}) == 2
+
+
+def test_cookies_are_not_shared(client, http_server):
+    client.get(url=http_server.url + "/cookie/userA")
+    thread = threading.Thread(target=lambda: client.get(url=http_server.url + "/a"))
+    thread.start()
+    thread.join()
+    client.get(url=http_server.url + "/b", cookies={"session": "userB"})
+    assert http_server.cookies == [None, None, "session=userB"]
+    assert not client.session().cookies
+
+
+def test_timeout_and_errors(client, http_server):
+    with pytest.raises(requests.exceptions.Timeout):
+        client.set_timeout(0.05).get(url=http_server.url + "/sleep/0.5")
+    assert client.get(url=http_server.url + "/sleep/0.1", timeout=2).status_code == 200
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.delete(url=http_server.url + "/status/404")
+    assert HttpClient.get_instance() is HttpClient.get_instance()
+
+
+def test_fan_out(client, http_server):
+    specs = [{"url": http_server.url + "/sleep/0.3"}, {"url": http_server.url + "/status/500"},
+             {"method": "POST", "url": http_server.url + "/b", "json": {}}, {"url": "http://127.0.0.1:1/"},
+             {"url": http_server.url + "/sleep/0.3"}]
+    start = time.monotonic()
+    results = client.fan_out(specs, max_concurrency=5)
+    assert time.monotonic() - start < 0.55
+    assert [result.ok for result in results] == [True, False, True, False, True]
+    assert results[0].response.json()["path"] == "/sleep/0.3"
+    assert results[1].response.status_code == 500 and isinstance(results[1].error, requests.exceptions.HTTPError)
+    assert isinstance(results[3].error, requests.exceptions.ConnectionError)
+    assert client.fan_out([]) == []
+
+
+def test_fan_out_deadline(client, http_server):
+    specs = [{"url": http_server.url + "/sleep/%s" % delay} for delay in (0, 1, 0, 0)]
+    start = time.monotonic()
+    results = client.fan_out(specs, max_concurrency=2, deadline=0.3)
+    assert time.monotonic() - start < 0.6
+    assert [result.ok for result in results] == [True, False, True, True]
+    assert isinstance(results[1].error, DeadlineExceededException)
+
+    results = client.fan_out(specs, max_concurrency=1, deadline=0.3)
+    assert [result.ok for result in results] == [True, False, False, False]
+
+
+def test_response_cache(client, http_server):
+    client.set_cache(HttpResponseCache())
+    fresh, stale = http_server.url + "/etag/60", http_server.url + "/etag/0"
+    for _ in range(3):
+        assert client.get(url=fresh, params={"b": 2, "a": 1}).json()["version"] == 1
+    assert client.get(url=fresh + "?a=1&b=2").json()["version"] == 1
+    assert len(http_server.requests) == 1
+
+    for _ in range(2):
+        assert client.get(url=stale).json()["version"] == 1
+    assert [request[1] for request in http_server.requests[1:]] == ["/etag/0", "/etag/0"]
+    http_server.version = 2
+    assert client.get(url=stale).json()["version"] == 2
+    assert client.get(url=stale, cache=False).json()["version"] == 2
+    assert client.get(url=stale, headers={"Authorization": "other"}).json()["version"] == 2
+    assert client.get(url=http_server.url + "/plain").json()["version"] == 2
+    assert client.cache().stats() == {"hits": 3, "revalidated": 1, "misses": 5, "entries": 3,
+                                      "bytes": client.cache().entries.bytes}
+
+
+def test_response_cache_key(client, http_server):
+    url = http_server.url + "/etag/60"
+    key = HttpResponseCache.key
+    assert key("GET", url, headers={"X-Tenant": "a"}) == key("GET", url, headers={"x-tenant": "a"})
+    assert len({key("GET", url), key("GET", url, headers={"X-Tenant": "a"}), key("GET", url, headers={"X-Tenant": "b"}),
+                key("GET", url, json={"a": 1}), key("GET", url, data={"a": 1})}) == 5
+    assert key("GET", url, data=iter([b"a"])) is None
+
+    client.set_cache(HttpResponseCache())
+    for tenant in ("a", "b", "a"):
+        assert client.get(url=url, headers={"X-Tenant": tenant}).status_code == 200
+    assert len(http_server.requests) == 2
+
+
+def test_response_cache_byte_bound(client, http_server):
+    cache = HttpResponseCache(max_bytes=1200)
+    client.set_cache(cache)
+    for max_age in (60, 61, 62):
+        client.get(url=http_server.url + "/etag/%s" % max_age)
+    assert len(cache.entries) == 2 and cache.entries.bytes <= 1200
+    client.get(url=http_server.url + "/etag/60")
+    assert cache.stats()["misses"] == 4
+
+
+def test_single_flight(client, http_server):
+    flight = SingleFlight()
+    client.set_single_flight(flight)
+    url = http_server.url + "/sleep/0.3"
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(client.get(url=url))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(http_server.requests) == 1
+    assert len({id(response) for response in responses}) == 1
+    assert flight.stats() == {"calls": 1, "shared": 4, "in_flight": 0}
+
+    client.get(url=url, single_flight=False)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get(url=http_server.url + "/status/503")
+    assert flight.stats()["calls"] == 2
+
+    threads = [threading.Thread(target=lambda tenant=tenant: client.get(url=url, headers={"X-Tenant": tenant}))
+               for tenant in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert flight.stats() == {"calls": 4, "shared": 4, "in_flight": 0}
+
+
+def test_hedging_and_adaptive_timeout(http_server, monkeypatch):
+    Conf.get_instance().app_conf = {"http_latency_min_samples": 5, "http_adaptive_timeout": True,
+                                    "http_min_timeout": 0.2}
+    client = HttpClient()
+    try:
+        url = http_server.url + "/script"
+        for _ in range(5):
+            client.get(url=url)
+        assert client.stats()["hosts"][http_server.url[7:]]["p95"] < 0.5
+
+        monkeypatch.setattr(client._HttpClient__hedge_budget, "tokens", 0)
+        http_server.script = [(200, 0.05)]
+        requests_sent = len(http_server.requests)
+        assert client.get(url=url, hedge=True).status_code == 200
+        assert (client.stats()["hedges"], client.stats()["hedges_denied"]) == (0, 1)
+        assert len(http_server.requests) == requests_sent + 1
+        monkeypatch.undo()
+
+        http_server.script = [(200, 1), (200, 0)]
+        start = time.monotonic()
+        assert client.get(url=url, hedge=True).status_code == 200
+        assert time.monotonic() - start < 0.5
+        assert (client.stats()["hedges"], client.stats()["hedges_won"]) == (1, 1)
+
+        with pytest.raises(requests.exceptions.Timeout):
+            client.get(url=http_server.url + "/sleep/0.5")
+        assert client.get(url=http_server.url + "/sleep/0.3", timeout=2).status_code == 200
+    finally:
+        client.close()
+
+
+def test_retries(client, http_server):
+    url = http_server.url + "/script"
+    http_server.script = [(503, 0), (502, 0)]
+    assert client.get(url=url, retries=2).status_code == 200
+    assert client.stats()["retries"] == 2
+
+    http_server.script = [(503, 0)]
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.post(url=url, retries=2)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get(url="http://127.0.0.1:1/", retries=1)
+    assert client.stats()["retries"] == 3
+    assert client.stats()["hosts"]["127.0.0.1:1"]["count"] == 2
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, max_tokens=1)
+    assert budget.withdraw() and not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    assert (budget.retries, budget.denied) == (2, 2)
@@ -0,0 +1,102 @@
+import datetime
+import enum
+import json
+import uuid
+from decimal import Decimal
+
+import pytest
+
+from model_test import Address, Person
+from pyboot.json import HttpResponse
+from pyboot.page import Page
+from pyboot.util.common import DatetimeUtil
+from pyboot.util.json import json_response, dump_json, load_json, register_encoder, set_json_backend
+
+
+def make_persons(count):
+    return [Person(id=i + 1, name="person %s" % i, age=i, active=i % 2 == 0) for i in range(count)]
+
+
+def test_to_json_dicts_matches_to_json_dict():
+    persons = make_persons(20)
+    assert Person.to_json_dicts(persons) == [person.to_json_dict() for person in persons]
+
+    addresses = [Address(id=1, street="Main", tags=[]), Address(id=2, zip="1", tags=["x"])]
+    assert Address.to_json_dicts(addresses, ["tags"]) == [address.to_json_dict(["tags"]) for address in addresses]
+
+
+def test_json_response_list():
+    persons = make_persons(5)
+    expected = dump_json([person.to_json_dict() for person in persons])
+    assert json_response(persons).get_data(as_text=True) == expected
+
+    mixed = persons + [HttpResponse(), 3]
+    body = load_json(json_response(mixed).get_data(as_text=True))
+    assert body[-2:] == [{"code": 0, "message": "Success"}, 3]
+    assert len(body) == 7
+
+
+def test_page_items():
+    page = Page()
+    page.items = make_persons(3)
+    page.gen_page_data(0, 3)
+    assert page.to_json_dict()["items"] == [person.to_json_dict() for person in page.items]
+
+
+def test_stream_matches_json_response():
+    persons = make_persons(7)
+    expected = json_response(persons).get_data(as_text=True)
+    assert json_response(persons, stream=True, chunk_size=3).get_data(as_text=True) == expected
+    assert json_response([], stream=True).get_data(as_text=True) == "[]"
+    assert json_response(iter([1, "a"]), stream=True).get_data(as_text=True) == dump_json([1, "a"])
+
+
+def test_stream_query(db):
+    db.add_all(make_persons(25))
+    db.commit()
+    expected = dump_json(Person.to_json_dicts(db.query(Person).order_by(Person.id).all()))
+    db.expunge_all()
+
+    response = json_response(db.query(Person).order_by(Person.id), stream=True, chunk_size=10)
+    assert response.is_streamed
+    assert response.get_data(as_text=True) == expected
+
+
+class Color(enum.Enum):
+    RED = "red"
+
+
+class Money(Decimal):
+    pass
+
+
+def test_default_encoders():
+    dt = datetime.datetime(2016, 8, 17, 9, 54, 53, 120)
+    value = {"dt": dt, "d": dt.date(), "t": dt.time(), "b": b"x", "u": uuid.UUID(int=1), "e": Color.RED,
+             "s": {1}, "g": (i for i in range(2)), "m": HttpResponse()}
+    assert load_json(dump_json(value)) == {
+        "dt": DatetimeUtil.dt_to_iso(dt), "d": "2016-08-17", "t": "09:54:53.000120", "b": "x",
+        "u": "00000000-0000-0000-0000-000000000001", "e": "red", "s": [1], "g": [0, 1],
+        "m": {"code": 0, "message": "Success"}}
+
+    with pytest.raises(TypeError):
+        dump_json(Decimal("1.5"))
+
+
+def test_register_encoder():
+    register_encoder(Decimal, str)
+    try:
+        assert dump_json([Decimal("1.5"), Money("2")]) == '["1.5", "2"]'
+    finally:
+        register_encoder(Decimal, None)
+    with pytest.raises(TypeError):
+        dump_json(Money("2"))
+
+
+def test_json_backend():
+    set_json_backend(lambda obj, default: json.dumps(obj, default=default, separators=(",", ":")).encode())
+    try:
+        assert dump_json({"a": [1, Color.RED]}) == '{"a":[1,"red"]}'
+    finally:
+        set_json_backend()
+    assert dump_json({"a": 1}) == '{"a": 1}'
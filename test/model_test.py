@@ -1,25 +1,216 @@
+import datetime
+
+from sqlalchemy import event
+from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Float
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import relationship
 
-from pyboot.model import DatabaseModelBase
+from pyboot.model import DatabaseModelBase, Model, TYPE_STR, TYPE_INT, TYPE_FLOAT, TYPE_BOOL, TYPE_DATETIME, \
+    TYPE_DATE, TYPE_LIST, TYPE_UNKNOWN
 
 
 class Client(DatabaseModelBase):
     __tablename__ = "clients"
 
     name = Column(String)
-    person_id = Column(Integer, ForeignKey("person.id"))
+    person_id = Column(Integer, ForeignKey("persons.id"))
+
+    person = relationship("Person", back_populates="clients")
 
 
 class Person(DatabaseModelBase):
     __tablename__ = "persons"
 
     name = Column(String)
+    age = Column(Integer)
+    height = Column(Float)
+    active = Column(Boolean)
+    created_on = Column(DateTime)
+
+    clients = relationship(Client, back_populates="person")
+
+
+class Address(Model):
+    _fields = {"id": TYPE_INT, "street": TYPE_STR, "zip": TYPE_INT, "lat": TYPE_FLOAT, "verified": TYPE_BOOL,
+               "since": TYPE_DATE, "checked_on": TYPE_DATETIME, "tags": TYPE_LIST, "extra": TYPE_UNKNOWN}
+
+    def __init__(self, **kwargs):
+        self.id = None
+        self.__dict__.update(kwargs)
+
+
+def legacy_to_dict(model):
+    obj_dict = {}
+    if model.id: obj_dict["id"] = model.id
+    fields = model.__class__._get_fields()
+    for field_name in fields.keys():
+        model._to_dict_field(obj_dict, field_name, fields[field_name])
+    return obj_dict
+
+
+def legacy_from_dict(model, obj_dict):
+    if "id" in obj_dict: model.id = obj_dict["id"]
+    fields = model.__class__._get_fields()
+    for field_name in fields:
+        model._from_dict_field(obj_dict, field_name, fields[field_name])
+    return model
+
+
+def test_to_dict_matches_field_ladder():
+    person = Person(id=3, name="", age="41", height=1.8, active=True,
+                    created_on=datetime.datetime(2016, 8, 17, 9, 54, 53))
+    assert person.to_dict() == legacy_to_dict(person)
+    assert list(person.to_dict()) == list(legacy_to_dict(person))
+    assert person.to_json_dict() == legacy_to_dict(person)
+
+    address = Address(id=7, street="Main", zip="560001", lat=12, verified="yes", since=datetime.date(2015, 1, 2),
+                      checked_on="2016-08-17T09:54:53Z", tags=["a", "b"], extra={"k": 1})
+    assert address.to_dict() == legacy_to_dict(address)
+
+    assert "tags" not in Address(tags=[]).to_dict()
+
+
+def test_from_dict_matches_field_ladder():
+    obj_dict = {"id": 5, "street": "Main", "zip": "560001", "lat": "12.5", "verified": "off",
+                "since": "2015-01-02", "tags": [1, 2], "extra": None}
+    assert Address().from_dict(obj_dict).__dict__ == legacy_from_dict(Address(), obj_dict).__dict__
+    assert Address().from_dict({}) is None
+
+
+class LabelledAddress(Address):
+    def _to_dict_field(self, obj_dict, name: str, type: str = None):
+        super()._to_dict_field(obj_dict, name, type)
+        if name == "street" and name in obj_dict: obj_dict[name] = obj_dict[name].upper()
+
+    def _from_dict_field(self, obj_dict: dict, name: str, type: str = None):
+        super()._from_dict_field(obj_dict, name, type)
+        if name == "street" and name in obj_dict: self.street = self.street.lower()
+
+
+def test_field_overrides_are_kept():
+    address = LabelledAddress(id=7, street="Main", zip=1)
+    assert address.to_dict() == {"id": 7, "street": "MAIN", "zip": 1}
+    assert LabelledAddress.to_json_dicts([address]) == [{"id": 7, "street": "MAIN", "zip": 1}]
+    assert LabelledAddress().from_dict({"street": "Main"}).street == "main"
+
+
+def test_serializer_is_cached_per_class():
+    assert Person._get_serializer() is Person._get_serializer()
+    assert Person._get_serializer() is not Client._get_serializer()
+
+
+def add_clients(db, count):
+    persons = [Person(id=i + 1, name="person %s" % i) for i in range(count)]
+    db.add_all(persons)
+    db.add_all([Client(id=i + 1, name="client %s" % i, person=persons[i % count]) for i in range(count * 2)])
+    db.commit()
+    db.expunge_all()
+
+
+def count_statements(engine, fn):
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    return len(statements)
+
+
+def test_join_tables_statement_count_is_constant(db, engine):
+    def read_clients(count):
+        clients = Client.get_all(db, count=count, order_by=Client.id, include=["person"])
+        assert len({client.person.name for client in clients}) == min(count, 100)
+        db.expunge_all()
+
+    def read_persons(count):
+        persons = Person.get_all(db, count=count, include=["clients.person", "unknown"])
+        assert sum(len(person.clients) for person in persons) == count * 2
+        assert all(client.person is person for person in persons for client in person.clients)
+        db.expunge_all()
+
+    add_clients(db, 100)
+    assert count_statements(engine, lambda: read_clients(20)) == count_statements(engine, lambda: read_clients(200))
+    assert count_statements(engine, lambda: read_persons(10)) == count_statements(engine, lambda: read_persons(100))
+    assert count_statements(engine, lambda: read_clients(200)) == 1
+
+
+def test_get_includes_relationships(db):
+    add_clients(db, 3)
+    client = Client.get(db, 2, include=["person"])
+    assert "person" in client.__dict__
+    assert Client.get(db, 3).person.name == "person 2"
+    assert Person._get_load_options(("clients",)) is Person._get_load_options(("clients",))
+
+
+def test_load_options_cache_is_normalized():
+    options = Client._get_load_options(("person.clients", "unknown", "person"))
+    assert Client._get_load_options(("person", "person.clients.bad", "nope.person")) is options
+    assert len(options) == 2 and Client._get_load_options(("unknown",)) == []
+    for index in range(500):
+        Client._get_load_options(("unknown%s" % index, "person"))
+    assert len(Client._load_options) <= 3
+
+
+def test_get_many(db, engine):
+    add_clients(db, 10)
+    cached = Client.get(db, 4)
+
+    ids = [7, 4, 99, 7, 1, 20, 13]
+    clients = []
+    statements = count_statements(engine, lambda: clients.extend(
+        Client.get_many(db, ids, include=["person"], keep_missing=True, chunk_size=2)))
+    assert [client.id if client else None for client in clients] == [7, 4, None, 7, 1, 20, 13]
+    assert clients[1] is cached and clients[0] is clients[3]
+    assert statements == 3
+    assert "person" in clients[-1].__dict__
+
+    assert [client.id for client in Client.get_many(db, [3, 99, 2])] == [3, 2]
+    assert Client.get_many(db, []) == []
+
+
+def test_bulk_insert(db):
+    rows = [{"id": i + 1, "name": "person %s" % i, "age": str(i)} for i in range(5)]
+    rows.append(Person(id=6, name="model", age=6))
+    result = Person.bulk_insert(db, rows, batch_size=2)
+    db.commit()
+    assert (result.rows, result.batches) == (6, 3)
+    assert [(person.id, person.age) for person in Person.get_all(db, order_by=Person.id)][-2:] == [(5, 4), (6, 6)]
+
+
+def test_bulk_upsert_and_delete_many(db):
+    Person.bulk_insert(db, [{"id": i + 1, "name": "person %s" % i, "age": i} for i in range(4)])
+    rows = [{"id": 2, "name": "updated", "age": 20}, {"id": 9, "name": "new", "age": 9},
+            {"id": 3, "name": "updated", "age": 30}, {"id": 3, "name": "twice", "age": 31}]
+    result = Person.bulk_upsert(db, rows, conflict_keys=["id"], update_fields=["name"], batch_size=3)
+    db.commit()
+    assert (result.rows, result.batches) == (4, 2)
+    assert [(person.id, person.name, person.age) for person in Person.get_all(db, order_by=Person.id)] == [
+        (1, "person 0", 0), (2, "updated", 1), (3, "twice", 2), (4, "person 3", 3), (9, "new", 9)]
+
+    Client.bulk_insert(db, [{"id": 1, "name": "a", "person_id": 1}, {"id": 2, "name": "b", "person_id": 1}])
+    Client.bulk_upsert(db, [{"name": "a", "person_id": 2}, {"name": "c", "person_id": 3}], ["name"])
+    assert sorted((client.name, client.person_id) for client in Client.get_all(db)) == [
+        ("a", 2), ("b", 1), ("c", 3)]
+
+    result = Person.delete_many(db, [1, 9, 9, 42], batch_size=2)
+    assert (result.rows, result.batches) == (2, 2)
+    assert [person.id for person in Person.get_all(db, order_by=Person.id)] == [2, 3, 4]
+
 
-    clients = relationship(Client)
+def test_mysql_upsert_statement():
+    dialect = mysql.dialect()
+    statement = str(Person._mysql_upsert([{"id": 1, "name": "a"}], ["id"], ["name"]).compile(dialect=dialect))
+    assert statement.endswith("ON DUPLICATE KEY UPDATE name = VALUES(name)")
+    statement = str(Person._mysql_upsert([{"id": 1}], ["id"], []).compile(dialect=dialect))
+    assert statement.endswith("ON DUPLICATE KEY UPDATE id = persons.id")
 
 
 if __name__ == "__main__":
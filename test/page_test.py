@@ -0,0 +1,154 @@
+import datetime
+
+import pytest
+from sqlalchemy import event, text
+
+from model_test import Person
+from pyboot.common.exception import InvalidValueException
+from pyboot.page import Page, PageCursor, COUNT_CACHED, COUNT_ESTIMATED
+
+
+def add_persons(db, count):
+    db.add_all([Person(id=i + 1, name="person %s" % i, age=i % 4,
+                       created_on=datetime.datetime(2016, 8, 17) + datetime.timedelta(hours=i % 3))
+                for i in range(count)])
+    db.commit()
+
+
+def get_page(db, count, order_by, cursor=None):
+    page = Page()
+    page.items = Person.get_all(db, count=count + 1, order_by=order_by, cursor=cursor, keyset=True)
+    page.gen_page_data(count=count, cursor=cursor, cursor_key=Person.cursor_key(order_by))
+    return page
+
+
+def walk(db, count, order_by):
+    pages = [get_page(db, count, order_by)]
+    while pages[-1].is_next_page:
+        pages.append(get_page(db, count, order_by, pages[-1].next_cursor))
+    return pages
+
+
+def test_offset_page_data():
+    page = Page()
+    page.items = list(range(6))
+    page.total_count = 20
+    page.gen_page_data(5, 5)
+    assert (page.count, page.is_prev_page, page.prev_page_start, page.is_next_page, page.next_page_start) == \
+           (5, True, 0, True, 10)
+    assert "next_cursor" not in page.to_json_dict()
+
+
+def test_offset_get_all(db):
+    add_persons(db, 10)
+    persons = Person.get_all(db, start=2, count=3, order_by=Person.id.desc())
+    assert [person.id for person in persons] == [8, 7, 6]
+
+
+@pytest.mark.parametrize("order_by", [None, Person.age.desc(), Person.created_on, Person.name.asc()])
+def test_keyset_walks_all_rows(db, order_by):
+    add_persons(db, 23)
+    expected = [person.id for person in Person.get_all(db, order_by=order_by, keyset=True)]
+    assert len(set(expected)) == 23
+
+    pages = walk(db, 5, order_by)
+    assert [len(page.items) for page in pages] == [5, 5, 5, 5, 3]
+    assert [person.id for page in pages for person in page.items] == expected
+    assert not pages[0].is_prev_page and pages[1].is_prev_page
+
+    back = [pages[-1]]
+    while back[-1].is_prev_page:
+        back.append(get_page(db, 5, order_by, back[-1].prev_cursor))
+    assert [[person.id for person in page.items] for page in reversed(back)] == \
+           [[person.id for person in page.items] for page in pages]
+    assert back[-1].is_next_page and not back[-1].is_prev_page
+
+
+@pytest.mark.parametrize("order_by", [Person.age, Person.age.desc()])
+def test_keyset_with_nulls(db, order_by):
+    add_persons(db, 23)
+    for person in db.query(Person).filter(Person.id % 3 == 0):
+        person.age = None
+    db.commit()
+
+    pages = walk(db, 5, order_by)
+    ids = [person.id for page in pages for person in page.items]
+    assert sorted(ids) == list(range(1, 24))
+    # SQLite sorts NULLs below every value
+    ages = [(person.age is not None, person.age, person.id) for page in pages for person in page.items]
+    assert ages == sorted(ages, reverse=order_by is not Person.age)
+
+    db.execute(text("create index persons_age_id on persons (age, id)"))
+    for page in pages[:-1]:
+        for query in Person._keyset_queries(db.query(Person), order_by=order_by, cursor=page.next_cursor)[0]:
+            statement = str(query.limit(5).statement.compile(db.get_bind(), compile_kwargs={"literal_binds": True}))
+            assert " OR persons.age IS NULL" not in statement
+            assert statement.split("ORDER BY ")[1].startswith("persons.age %s, persons.id" % (
+                "DESC" if order_by is not Person.age else "ASC"))
+            plan = " ".join(row[-1] for row in db.execute(text("explain query plan %s" % statement)))
+            assert "persons_age_id" in plan and "TEMP B-TREE" not in plan
+
+    back = [pages[-1]]
+    while back[-1].is_prev_page:
+        back.append(get_page(db, 5, order_by, back[-1].prev_cursor))
+    assert [person.id for page in reversed(back) for person in page.items] == ids
+
+
+def test_cursor_round_trip():
+    values = [datetime.datetime(2016, 8, 17, 9, 54, 53, 12), datetime.date(2016, 8, 17), "a", 1, None]
+    assert PageCursor.decode(PageCursor.encode(PageCursor.PREV, values)) == (PageCursor.PREV, values)
+    with pytest.raises(InvalidValueException):
+        PageCursor.decode("not-a-cursor")
+
+
+def count_statements(engine):
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    return statements
+
+
+@pytest.mark.parametrize("window", [True, False])
+def test_from_query_exact(db, engine, monkeypatch, window):
+    add_persons(db, 12)
+    if not window: monkeypatch.setattr(Page, "_Page__window_count_supported", staticmethod(lambda query: False))
+    statements = count_statements(engine)
+
+    page = Page.from_query(db.query(Person).order_by(Person.id), start=5, count=5)
+    assert [person.id for person in page.items] == [6, 7, 8, 9, 10]
+    assert (page.total_count, page.is_next_page, page.next_page_count) == (12, True, 2)
+    assert len(statements) == (1 if window else 2)
+
+    page = Page.from_query(db.query(Person).order_by(Person.id), start=20, count=5)
+    assert (page.items, page.total_count, page.is_prev_page) == ([], 12, True)
+
+
+@pytest.mark.parametrize("total", [None, COUNT_CACHED])
+def test_from_query_distinct(db, total):
+    add_persons(db, 12)
+    query = db.query(Person.age).distinct().order_by(Person.age)
+    page = Page.from_query(query, count=3, total=total) if total else Page.from_query(query, count=3)
+    assert (page.items, page.total_count, page.is_next_page) == ([(0,), (1,), (2,)], 4, True)
+    page = Page.from_query(db.query(Person.age).order_by(Person.id), count=3)
+    assert (page.items, page.total_count) == ([(0,), (1,), (2,)], 12)
+
+
+def test_from_query_cached(db, engine):
+    add_persons(db, 12)
+    query = db.query(Person).filter(Person.age > 0).order_by(Person.id)
+    first = Page.from_query(query, start=0, count=5, total=COUNT_CACHED)
+    statements = count_statements(engine)
+    second = Page.from_query(db.query(Person).filter(Person.age > 0), start=5, count=5, total=COUNT_CACHED)
+    assert first.total_count == second.total_count == 9
+    assert len(statements) == 1
+    assert "count" not in statements[0].lower()
+
+    other = Page.from_query(db.query(Person).filter(Person.age > 1), start=0, count=5, total=COUNT_CACHED)
+    assert other.total_count == 6
+
+
+def test_from_query_estimated(db):
+    add_persons(db, 12)
+    page = Page.from_query(db.query(Person).order_by(Person.id), start=5, count=5, total=COUNT_ESTIMATED)
+    assert (page.count, page.total_count, page.is_next_page, page.next_page_count) == (5, None, True, 5)
+    page = Page.from_query(db.query(Person).order_by(Person.id), start=10, count=5, total=COUNT_ESTIMATED)
+    assert (page.count, page.is_next_page) == (2, False)